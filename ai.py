@@ -0,0 +1,247 @@
+"""ai.py - Computer player for Connect Four.
+
+Negamax search with alpha-beta pruning over the engine bitboards, deepened
+iteratively until the time budget runs out.  Moves are tried center column
+first, after the best move remembered for the position.  A position is keyed
+by position + mask (the side to move's chips plus every chip), which is
+unique and is updated incrementally as moves are made.  Searched positions go
+in a bounded, least recently used transposition table shared by all requests
+on the instance, and chosen moves are also kept in memcache so other
+instances can reuse them.  Positions in the precomputed book (see book) are
+answered without searching."""
+
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+import book
+import engine
+
+COMPUTER_NAME = 'Computer'
+# Entries take a few hundred bytes each, so this keeps the table to a few
+# MB of the instance's memory.
+TABLE_SIZE = 20000
+# Nodes searched between checks of the clock.  Classic boards search tens
+# of thousands of nodes a second, so this overruns the budget by about a
+# millisecond at most.
+CHECK_INTERVAL = 64
+DEFAULT_TIME_BUDGET = 0.5
+MEMCACHE_AI_MOVE = 'AI_MOVE:{0}x{1}x{2}:{3}'
+# Wins score above any heuristic value, earlier wins higher.
+WIN_SCORE = 10000
+EXACT, LOWER, UPPER = range(3)
+
+
+class TranspositionTable(object):
+
+    """Bounded table of searched positions, evicting the least recently
+    used entry when full"""
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            if len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+_table = TranspositionTable(TABLE_SIZE)
+
+
+class _Timeout(Exception):
+    pass
+
+
+def _playable(geometry, mask, col):
+    return not mask & geometry.top_bit(col)
+
+
+def _move_bit(geometry, mask, col):
+    return (mask + geometry.bottom_bit(col)) & geometry.column_mask(col)
+
+
+def evaluate(geometry, position, mask):
+    """Heuristic value of a position for the side to move: open winning
+    cells of the player minus those of the opponent"""
+    return (engine.popcount(geometry.winning_spots(position, mask)) -
+            engine.popcount(geometry.winning_spots(position ^ mask, mask)))
+
+
+class Search(object):
+
+    def __init__(self, deadline, geometry=engine.CLASSIC, table=_table):
+        self.deadline = deadline
+        self.geometry = geometry
+        self.table = table
+        self.nodes = 0
+
+    def negamax(self, position, mask, moves, depth, alpha, beta):
+        """Returns the value of the position for the side to move, whose
+        chips are position, with moves chips on the board"""
+        self.nodes += 1
+        if (self.nodes % CHECK_INTERVAL == 0 and
+                time.time() > self.deadline):
+            raise _Timeout()
+        geometry = self.geometry
+        if moves == geometry.cells:
+            return 0
+        for col in geometry.center_order:
+            if (_playable(geometry, mask, col) and geometry.is_win(
+                    position | _move_bit(geometry, mask, col))):
+                return WIN_SCORE - moves
+        if depth == 0:
+            return evaluate(geometry, position, mask)
+
+        # Variants share the table, so the key includes the geometry.
+        key = (geometry, position + mask)
+        entry = self.table.get(key)
+        first = None
+        if entry is not None:
+            entry_depth, flag, value, first = entry
+            if entry_depth >= depth:
+                if flag == EXACT:
+                    return value
+                elif flag == LOWER:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+
+        original_alpha = alpha
+        best_value, best_col = -WIN_SCORE - 1, None
+        order = geometry.center_order if first is None else \
+            [first] + [col for col in geometry.center_order if col != first]
+        for col in order:
+            if not _playable(geometry, mask, col):
+                continue
+            # After our move the opponent is to move, holding position ^ mask.
+            value = -self.negamax(position ^ mask,
+                                  mask | _move_bit(geometry, mask, col),
+                                  moves + 1, depth - 1, -beta, -alpha)
+            if value > best_value:
+                best_value, best_col = value, col
+            alpha = max(alpha, value)
+            if alpha >= beta:
+                break
+
+        if best_value <= original_alpha:
+            flag = UPPER
+        elif best_value >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table.put(key, (depth, flag, best_value, best_col))
+        return best_value
+
+
+def choose_move(position, mask, time_budget=DEFAULT_TIME_BUDGET,
+                geometry=engine.CLASSIC):
+    """Returns (column, value, depth, nodes) for the side to move, whose
+    chips are position. value is positive when the side to move is ahead.
+    Positions in the book are answered from it without searching.
+    Raises ValueError if the board is full."""
+    playable = _playable_columns(position, mask, geometry)
+    entry = book.lookup(position, mask, geometry)
+    if entry is not None:
+        return (entry.column, entry.score,
+                entry.search_depth(mask, geometry), 0)
+    if isinstance(playable, tuple):
+        return playable
+
+    cache_key = MEMCACHE_AI_MOVE.format(geometry.width, geometry.height,
+                                        geometry.win_length, position + mask)
+    cached = memcache.get(cache_key)
+    best = _deepen(Search(time.time() + time_budget, geometry), position,
+                   mask, playable, cached or (playable[0], 0, 0, 0))
+    if best[2] > (cached[2] if cached else 0):
+        memcache.set(cache_key, best)
+    return best
+
+
+def analyse(position, mask, depth, geometry=engine.CLASSIC):
+    """choose_move searching to a fixed depth, with no time limit and
+    neither the book nor memcache, for building the book offline"""
+    playable = _playable_columns(position, mask, geometry)
+    if isinstance(playable, tuple):
+        return playable
+    return _deepen(Search(float('inf'), geometry), position, mask, playable,
+                   (playable[0], 0, 0, 0), depth)
+
+
+def is_solved(value, depth, mask, geometry=engine.CLASSIC):
+    """Returns True if a search result is the game's outcome: a forced win
+    or loss was found, or the search reached the end of the game"""
+    return (abs(value) >= WIN_SCORE - geometry.cells or
+            depth >= geometry.cells - engine.popcount(mask))
+
+
+def _playable_columns(position, mask, geometry):
+    """Returns the playable columns in search order, or the choose_move
+    result if one of them wins at once. Raises ValueError if there are
+    none."""
+    playable = [col for col in geometry.center_order
+                if _playable(geometry, mask, col)]
+    if not playable:
+        raise ValueError('Board is full')
+    for col in playable:
+        if geometry.is_win(position | _move_bit(geometry, mask, col)):
+            return col, WIN_SCORE - engine.popcount(mask), 1, 1
+    return playable
+
+
+def _deepen(search, position, mask, playable, best, max_depth=None):
+    """Iteratively deepens from one past best's depth until the search runs
+    out of time, reaches max_depth or finds the result, and returns the
+    (column, value, depth, nodes) of the deepest complete iteration"""
+    moves = engine.popcount(mask)
+    cells = search.geometry.cells
+    last = cells - moves if max_depth is None else min(max_depth,
+                                                       cells - moves)
+    for depth in range(max(1, best[2] + 1), last + 1):
+        try:
+            value, col = _search_root(search, position, mask, moves,
+                                      playable, depth, best[0])
+        except _Timeout:
+            break
+        best = (col, value, depth, search.nodes)
+        if abs(value) >= WIN_SCORE - cells:
+            # Forced result found, deeper search can't change it.
+            break
+    return best
+
+
+def _search_root(search, position, mask, moves, playable, depth, first):
+    alpha, beta = -WIN_SCORE - 1, WIN_SCORE + 1
+    best_value, best_col = -WIN_SCORE - 1, playable[0]
+    order = [first] + [col for col in playable if col != first] \
+        if first in playable else playable
+    for col in order:
+        value = -search.negamax(position ^ mask,
+                                mask | _move_bit(search.geometry, mask, col),
+                                moves + 1, depth - 1, -beta, -alpha)
+        if value > best_value:
+            best_value, best_col = value, col
+        alpha = max(alpha, value)
+    return best_value, best_col
+
+
+def choose_game_move(game, time_budget=DEFAULT_TIME_BUDGET):
+    """choose_move for the player whose turn it is in a Game"""
+    game.upgrade()
+    position = game.board1 if game.player_1_turn else game.board2
+    return choose_move(position, game.board1 | game.board2, time_budget,
+                       game.geometry())
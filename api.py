@@ -5,31 +5,100 @@ move game logic to another file. Ideally the API will be simple, concerned
 primarily with communication to/from the API's users."""
 
 
+from datetime import datetime
+
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
-from models import User, Game, Score
+import ai
+import book
+import engine
+import gamecache
+import gamestats
+import matchmaking
+import tournaments
+from instrument import instrumented, timed_call
+import usernames
+from models import Game, Score, Tournament, UserStats, unpack_moves
 from models import StringMessage, NewGameForm, GameForm, MakeMoveForm,\
-    ScoreForms, GameForms, UserRank, UserRanks, HistoricalRecord, \
-    HistoryForms
-from utils import get_by_urlsafe
+    ScoreForms, GameForms, UserRanks, HistoryForms, NewGamesForm, \
+    MakeMovesForm, GameResultForm, GameResultForms, GameStatsForm, AiMoveForm,\
+    JoinQueueForm, MatchForm, PositionForm, NewTournamentForm, \
+    TournamentForm, StandingForms
+from utils import get_key_by_urlsafe, get_cursor, next_cursor, EntityMap
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    compact=messages.BooleanField(2),
+    etag=messages.StringField(3),
+    since_move=messages.IntegerField(4))
+CANCEL_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
 GET_USER_GAMES_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1))
+GET_GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    from_move=messages.IntegerField(2),
+    limit=messages.IntegerField(3))
+AI_MOVE_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    time_budget_ms=messages.IntegerField(2))
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+SCORES_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1),
+    cursor=messages.StringField(2),
+    date_from=messages.StringField(3),
+    date_to=messages.StringField(4),
+    won=messages.BooleanField(5))
+USER_SCORES_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2),
+    cursor=messages.StringField(3),
+    date_from=messages.StringField(4),
+    date_to=messages.StringField(5),
+    won=messages.BooleanField(6))
+EVALUATE_POSITION_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    moves=messages.StringField(2),
+    width=messages.IntegerField(3, default=engine.WIDTH),
+    height=messages.IntegerField(4, default=engine.HEIGHT),
+    win_length=messages.IntegerField(5, default=engine.WIN_LENGTH))
+WATCH_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    since_move=messages.IntegerField(2, default=0),
+    wait_seconds=messages.IntegerField(3))
+POLL_MATCH_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    wait_seconds=messages.IntegerField(2))
 USER_RANKINGS = endpoints.ResourceContainer(
-    max_number=messages.IntegerField(1))
+    max_number=messages.IntegerField(1),
+    cursor=messages.StringField(2))
+GET_TOURNAMENT_REQUEST = endpoints.ResourceContainer(
+    urlsafe_tournament_key=messages.StringField(1))
+STANDINGS_REQUEST = endpoints.ResourceContainer(
+    urlsafe_tournament_key=messages.StringField(1),
+    page_size=messages.IntegerField(2),
+    cursor=messages.StringField(3))
 
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+DEFAULT_RANKINGS_PAGE_SIZE = 20
+MAX_RANKINGS_PAGE_SIZE = 100
+DEFAULT_SCORES_PAGE_SIZE = 20
+DEFAULT_STANDINGS_PAGE_SIZE = 50
+MAX_STANDINGS_PAGE_SIZE = 200
+MAX_SCORES_PAGE_SIZE = 100
+MAX_BATCH_SIZE = 100
+MAX_AI_TIME_BUDGET_MS = 5000
+MAX_POLL_SECONDS = 20
+MAX_WATCH_SECONDS = 25
+# Search time for positions missing from the book.
+EVALUATION_BUDGET = 0.1
+NEW_GAME_MESSAGE = 'Good luck playing Connect Four! Player {0} goes first'
 
 
 @endpoints.api(name='connect_four', version='v1')
@@ -41,13 +110,17 @@ class Connect4Api(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username"""
-        if User.query(User.name == request.user_name).get():
+        if (usernames.normalize(request.user_name) ==
+                usernames.normalize(ai.COMPUTER_NAME)):
+            raise endpoints.ConflictException(
+                'That name is reserved for the computer player')
+        user = usernames.create_user(request.user_name, request.email)
+        if not user:
             raise endpoints.ConflictException(
                 'A User with that name already exists!')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
         return StringMessage(message='User {} created.'.format(
             request.user_name))
 
@@ -56,49 +129,160 @@ class Connect4Api(remote.Service):
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
         """Creates new game"""
-        user1 = User.query(User.name == request.user_1).get()
-        user2 = User.query(User.name == request.user_2).get()
+        if request.vs_computer:
+            users_future = usernames.get_users_async([request.user_1])
+            user2 = _computer_user()
+            user1 = users_future.get_result().get(request.user_1)
+        else:
+            users = usernames.get_users([request.user_1, request.user_2])
+            user1 = users.get(request.user_1)
+            user2 = users.get(request.user_2)
         if not user1 or not user2:
             raise endpoints.NotFoundException(
                 'A Users with those names do not exist!')
+        geometry = _geometry(request)
         try:
-            game = Game.new_game(user1.key, user2.key)
+            game = Game.build(user1.key, user2.key, request.vs_computer,
+                              geometry)
         except ValueError:
             raise endpoints.BadRequestException('User cannot play himself.')
+        put_future = game.put_async()
+
+        # Only bumps a counter shard; the derived stats are recomputed by
+        # one task per time window, out of sequence.
+        gamestats.record(games_created=1)
+        put_future.get_result()
+        entities = EntityMap()
+        entities.add(user1)
+        entities.add(user2)
+        return game.to_form(NEW_GAME_MESSAGE.format(user1.name), entities)
+
+    @endpoints.method(request_message=NewGamesForm,
+                      response_message=GameResultForms,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    @instrumented
+    def new_games(self, request):
+        """Creates several games at once. Returns a game or an error for each
+        requested game, in order"""
+        _check_batch_size(request.items)
+        users_future = usernames.get_users_async(
+            [name for item in request.items
+             for name in (item.user_1, item.user_2)])
+        computer = None
+        if any(item.vs_computer for item in request.items):
+            computer = _computer_user()
+        users = users_future.get_result()
+        if computer:
+            users[computer.name] = computer
+        results = []
+        for item in request.items:
+            user1 = users.get(item.user_1)
+            user2 = users.get(ai.COMPUTER_NAME if item.vs_computer
+                              else item.user_2)
+            if not user1 or not user2:
+                results.append((None, 'A Users with those names do not exist!'))
+                continue
+            try:
+                geometry = _geometry(item)
+            except endpoints.BadRequestException as e:
+                results.append((None, e.message))
+                continue
+            try:
+                results.append((Game.build(user1.key, user2.key,
+                                           item.vs_computer, geometry), None))
+            except ValueError:
+                results.append((None, 'User cannot play himself.'))
 
-        # Use a task queue to update the average attempts remaining.
-        # This operation is not needed to complete the creation of a new game
-        # so it is performed out of sequence.
-        taskqueue.add(url='/tasks/cache_average_attempts')
-        return game.to_form('Good luck playing Connect Four! Player {0} \
-        goes first'.format(user1.name))
+        games = [game for game, _ in results if game]
+        ndb.put_multi(games)
+        if games:
+            gamestats.record(games_created=len(games))
+        entities = EntityMap()
+        for user in users.values():
+            entities.add(user)
+        return GameResultForms(items=[
+            GameResultForm(error=error) if error else GameResultForm(
+                game=game.to_form(NEW_GAME_MESSAGE.format(
+                    entities.get(game.user1).name), entities))
+            for game, error in results])
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            return game.to_form('Time to make a move.')
-        else:
+        game = gamecache.get_game(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game))
+        if not game:
             raise endpoints.NotFoundException('Game not found.')
+        if request.etag and request.etag == game.etag():
+            return game.not_modified_form()
+        if request.since_move is not None:
+            if not 0 <= request.since_move <= game.move_count:
+                raise endpoints.BadRequestException(
+                    'since_move is outside the game')
+            return game.to_compact_form('Time to make a move.',
+                                        request.since_move)
+        if request.compact:
+            return game.to_compact_form('Time to make a move.')
+        return game.to_form('Time to make a move.')
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=WATCH_GAME_REQUEST,
+                      response_message=GameForm,
+                      path='game/{urlsafe_game_key}/watch',
+                      name='watch_game',
+                      http_method='GET')
+    @instrumented
+    def watch_game(self, request):
+        """Long polls a game for moves after since_move, waiting up to
+        wait_seconds (at most 25). Returns the new moves as a compact
+        since_move form, or not_modified if none were made in time."""
+        if request.since_move < 0:
+            raise endpoints.BadRequestException(
+                'since_move cannot be negative')
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        wait = max(0, min(request.wait_seconds or 0, MAX_WATCH_SECONDS))
+        state = gamecache.wait_for_move(game_key, request.since_move, wait)
+        if state is None:
+            raise endpoints.NotFoundException('Game not found.')
+        move_count, game_over = state
+        if request.since_move > move_count:
+            raise endpoints.BadRequestException(
+                'since_move is outside the game')
+        if move_count == request.since_move and not game_over:
+            return GameForm(urlsafe_key=request.urlsafe_game_key,
+                            game_over=False, message='No new moves',
+                            not_modified=True, move_count=move_count)
+        game = gamecache.get_game(game_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found.')
+        return game.to_compact_form('New moves',
+                                    min(request.since_move,
+                                        game.move_count))
+
+    @endpoints.method(request_message=GET_GAME_HISTORY_REQUEST,
                       response_message=HistoryForms,
                       path='game_history/{urlsafe_game_key}',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
         """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = gamecache.get_game(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game))
+        if (request.from_move or 0) < 0 or (request.limit or 0) < 0:
+            raise endpoints.BadRequestException(
+                'from_move and limit cannot be negative')
         if game:
-            return HistoryForms(
-                items=[history.to_form() for history in game.game_history])
+            return game.history_forms(request.from_move or 0, request.limit)
         else:
             raise endpoints.NotFoundException('Game History not found.')
 
@@ -107,32 +291,53 @@ class Connect4Api(remote.Service):
                       path='games/user/{user_name}',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
         """Get the users remaining open games"""
-        user = User.query(User.name == request.user_name).get()
+        user = usernames.get_user(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A Users with those name do not exist.')
-        games_left = Game.query(ndb.AND(ndb.OR(Game.user1 == user.key,
-                                              Game.user2 == user.key),
-                                       Game.game_over == False))
+        games = Game.query(Game.players == user.key,
+                           Game.open == True).fetch()
+        # The datastore copy of a live game can be behind its cached copy;
+        # the cache and the players are read concurrently.
+        entities = EntityMap()
+        entities.add(user)
+        users_loaded = entities.prefetch_async(
+            [key for game in games for key in game.user_keys()])
+        games_left = [game for game in
+                      gamecache.overlay_async(games).get_result()
+                      if game.open]
+        users_loaded.get_result()
         return GameForms(
-            items=[game.to_form("Open Game") for game in games_left])
+            items=[game.to_form("Open Game", entities)
+                   for game in games_left])
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=CANCEL_GAME_REQUEST,
                       response_message=StringMessage,
                       path='cancel/game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @instrumented
     def cancel_game(self, request):
         """Cancel the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = gamecache.get_game(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game))
         if game:
             if game.game_over:
                 raise endpoints.UnauthorizedException(
                     "Can't cancel completed game")
+            elif game.tournament:
+                raise endpoints.ConflictException(
+                    "Can't cancel a tournament game")
             else:
-                game.key.delete()
+                # Deleting the game also drops it from the players/open
+                # index, so nothing else needs updating.
+                deleted = game.key.delete_async()
+                gamestats.record(games_cancelled=1)
+                gamecache.evict(game.key)
+                deleted.get_result()
                 return StringMessage(message='Game {} canceled and deleted.'.
                                      format(request.urlsafe_game_key))
         else:
@@ -143,131 +348,484 @@ class Connect4Api(remote.Service):
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        # The game and the user are looked up concurrently.
+        users_future = usernames.get_users_async([request.user])
+        game = gamecache.get_game_async(game_key).get_result()
+        if not game:
+            raise endpoints.NotFoundException('Game not found.')
+        if request.request_id and request.request_id in game.recent_requests:
+            return game.to_form('Move already applied')
         if game.game_over:
             return game.to_form('Game already over!')
 
-        user = User.query(User.name == request.user).get()
+        user = users_future.get_result().get(request.user)
         if not user:
             raise endpoints.NotFoundException(
                 'A Users with those name do not exist!')
 
-        # handle all incorrect turn attempts or users not in the game
-        if game.player_1_turn and user.key != game.user1:
-            if user.key != game.user2:
-                raise endpoints.NotFoundException(
-                    'User not in this game')
-            else:
-                raise endpoints.ConflictException(
-                    'Not your turn')
-        elif not game.player_1_turn and user.key != game.user2:
-            if user.key != game.user1:
-                raise endpoints.NotFoundException(
-                    'User not in this game')
-            else:
-                raise endpoints.ConflictException(
-                    'Not your turn')
+        entities = EntityMap()
+        entities.add(user)
+        entities.prefetch(game.user_keys())
 
-        # Make sure user picked a valid column.
-        if request.column < 0 or request.column > 6:
-            raise endpoints.BadRequestException(
-                'Must select a column between 0 and 6')
-
-        # player 1 chip is 1, player 2 chip is 2.
-        player_chip = 1 if game.player_1_turn else 2
-
-        for idx, val in enumerate(game.gamegrid[request.column].row):
-            # replace the lowest unoccupied space(indicated by a 0) 
-            # with the current chip.
-            if val == 0:
-                game.gamegrid[request.column].row[idx] = player_chip
-                break
-            elif idx == 6:
-                raise endpoints.ConflictException(
-                    'column is already full, pick another')
-
-        if game.has_last_chip_won(request.column, endpoints):
-            # Player just won, end game accordingly
-            history = HistoricalRecord(
-                player_name=user.name, column=request.column,
-                game_state="Just Won!")
-            game.game_history.append(history)
-            game.end_game(user.key, True)
-            msg = "Player {0} just won!".format(user.name)
-        elif game.spaces_left() == 0:
-            # there are no open spaces, tie game
-            history = HistoricalRecord(
-                player_name=user.name, column=request.column,
-                game_state="Tie Game")
-            game.game_history.append(history)
-            game.end_game()
-            msg = "Game over, all spaces filled.  There are no winners here."
+        # The move is applied to the cached game with compare-and-set, so a
+        # move racing this one is re-validated against the updated state.
+        try:
+            updated = gamecache.update_game(
+                game_key,
+                lambda game: _play_turn(game, user, request.column, entities,
+                                        request.request_id))
+        except gamecache.GameContentionError:
+            raise endpoints.ConflictException(
+                'Game is being updated, try again')
+        if not updated:
+            raise endpoints.NotFoundException('Game not found.')
+        game, msg = updated
+        return game.to_form(msg, entities)
+
+    @endpoints.method(request_message=AI_MOVE_REQUEST,
+                      response_message=AiMoveForm,
+                      path='game/{urlsafe_game_key}/ai_move',
+                      name='get_ai_move',
+                      http_method='GET')
+    @instrumented
+    def get_ai_move(self, request):
+        """Returns the computer player's choice of move for whoever's turn it
+        is, searching for at most time_budget_ms (default 500)"""
+        game = gamecache.get_game(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game))
+        if not game:
+            raise endpoints.NotFoundException('Game not found.')
+        if game.game_over:
+            raise endpoints.ConflictException('Game already over!')
+        budget = min(request.time_budget_ms or
+                     int(ai.DEFAULT_TIME_BUDGET * 1000), MAX_AI_TIME_BUDGET_MS)
+        column, score, depth, nodes = ai.choose_game_move(game,
+                                                          budget / 1000.0)
+        return AiMoveForm(column=column, score=score, depth=depth,
+                          nodes=nodes)
+
+    @endpoints.method(request_message=EVALUATE_POSITION_REQUEST,
+                      response_message=PositionForm,
+                      path='position',
+                      name='evaluate_position',
+                      http_method='GET')
+    @instrumented
+    def evaluate_position(self, request):
+        """Evaluates the position of a game, or the one reached by playing
+        moves (packed as in GameForm) on an empty board of the variant, for
+        the player to move. Book positions are answered from the book, other
+        positions with a short search"""
+        if request.urlsafe_game_key:
+            game = gamecache.get_game(
+                get_key_by_urlsafe(request.urlsafe_game_key, Game))
+            if not game:
+                raise endpoints.NotFoundException('Game not found.')
+            if game.game_over:
+                raise endpoints.ConflictException('Game already over!')
+            game.upgrade()
+            geometry = game.geometry()
+            position = game.board1 if game.player_1_turn else game.board2
+            mask = game.board1 | game.board2
         else:
-            # normal turn, next players turn. 
-            history = HistoricalRecord(
-                player_name=user.name, column=request.column,
-                game_state="Next player's turn")
-            game.game_history.append(history)
-            game.player_1_turn = not game.player_1_turn
-            if game.player_1_turn:
-                msg = 'Player {0} is up next'.format(game.user1.get().name)
-            else:
-                msg = 'Player {0} is up next'.format(game.user2.get().name)
+            geometry = _geometry(request)
+            position, mask = _position_after(request.moves or '', geometry)
+
+        entry = book.lookup(position, mask, geometry)
+        if entry is not None:
+            column, score = entry.column, entry.score
+            depth = entry.search_depth(mask, geometry)
+            solved = entry.solved
+        else:
+            try:
+                column, score, depth, _ = ai.choose_move(
+                    position, mask, EVALUATION_BUDGET, geometry)
+            except ValueError:
+                raise endpoints.ConflictException('Board is full')
+            solved = ai.is_solved(score, depth, mask, geometry)
+        outcome = None
+        if solved:
+            outcome = 'win' if score > 0 else 'loss' if score < 0 else 'draw'
+        return PositionForm(column=column, score=score, depth=depth,
+                            solved=solved, outcome=outcome,
+                            from_book=entry is not None)
+
+    @endpoints.method(request_message=MakeMovesForm,
+                      response_message=GameResultForms,
+                      path='games/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @instrumented
+    def make_moves(self, request):
+        """Makes several moves at once, applied in request order within each
+        game. Returns the game state after the batch or an error for each
+        move, in order"""
+        _check_batch_size(request.items)
+        users = usernames.get_users([item.user for item in request.items])
+        entities = EntityMap()
+        for user in users.values():
+            entities.add(user)
+
+        results = [None] * len(request.items)
+        moves_by_game = {}
+        for index, item in enumerate(request.items):
+            try:
+                game_key = get_key_by_urlsafe(item.urlsafe_game_key, Game)
+            except (endpoints.BadRequestException, ValueError):
+                results[index] = (None, None, 'Invalid Key')
+                continue
+            user = users.get(item.user)
+            if not user:
+                results[index] = (None, None,
+                                  'A Users with those name do not exist!')
+                continue
+            moves_by_game.setdefault(game_key, []).append(
+                (index, user, item.column, item.request_id))
 
-        game.put()
-        return game.to_form(msg)
+        def play_moves(moves):
+            def apply(game):
+                outcomes = []
+                for index, user, column, request_id in moves:
+                    try:
+                        outcomes.append(
+                            (index, _play_turn(game, user, column, entities,
+                                               request_id), None))
+                    except endpoints.ServiceException, e:
+                        outcomes.append((index, None, str(e)))
+                return outcomes
+            return apply
 
-    @endpoints.method(response_message=ScoreForms,
+        updated = gamecache.update_games(
+            dict((game_key, play_moves(moves))
+                 for game_key, moves in moves_by_game.items()))
+        for game_key, moves in moves_by_game.items():
+            game, outcome = updated.get(game_key, (None, None))
+            if game is None:
+                error = ('Game is being updated, try again' if outcome
+                         else 'Game not found.')
+                for move in moves:
+                    results[move[0]] = (None, None, error)
+                continue
+            for index, msg, error in outcome:
+                results[index] = (game, msg, error)
+
+        entities.prefetch([key for game, _, _ in results if game
+                           for key in game.user_keys()])
+        return GameResultForms(items=[
+            GameResultForm(error=error) if error else GameResultForm(
+                game=game.to_form(msg, entities))
+            for game, msg, error in results])
+
+    @endpoints.method(request_message=SCORES_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of scores, newest first"""
+        return _scores_page(Score.query(), request, EntityMap())
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_SCORES_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns a page of an individual User's scores, newest first"""
+        user = usernames.get_user(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
-        scores = Score.query(
-            ndb.OR(Score.loser == user.key, Score.winner == user.key))
-        return ScoreForms(items=[score.to_form() for score in scores])
+        entities = EntityMap()
+        entities.add(user)
+        return _scores_page(Score.query(Score.players == user.key), request,
+                            entities)
 
     @endpoints.method(request_message=USER_RANKINGS,
                       response_message=UserRanks,
                       path='rankings',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
         """Returns the user rankings, sorted by highest first, up to number
-         indicated"""
-        users = User.query()
-        rankings = []
-        for user in users:
-            total_scores = Score.query(
-                ndb.OR(Score.loser == user.key, Score.winner == user.key))
-            winning_scores = Score.query(
-                ndb.AND(Score.winner == user.key, Score.won == True))
-            win_p = 0.0
-            if total_scores.count() > 0:
-                win_p = winning_scores.count()/float(total_scores.count())
-            userRank = UserRank(
-                user_name=user.name, wins=winning_scores.count(),
-                win_percent=win_p)
-            rankings.append(userRank)
-        sorted(rankings, key=lambda UserRank: UserRank.wins, reverse=True)
-        if request.max_number != None:
-            rankings = rankings[0:request.max_number]
-        return UserRanks(items=rankings)
+         indicated. Pass the returned next_cursor to get the following
+         page"""
+        page_size = max(1, min(request.max_number or
+                               DEFAULT_RANKINGS_PAGE_SIZE,
+                               MAX_RANKINGS_PAGE_SIZE))
+        stats, cursor, more = UserStats.query().order(
+            -UserStats.wins, -UserStats.win_percent).fetch_page(
+                page_size, start_cursor=get_cursor(request.cursor))
+        return UserRanks(items=[stat.to_form() for stat in stats],
+                         next_cursor=next_cursor(cursor, more))
+
+    @endpoints.method(response_message=GameStatsForm,
+                      path='stats',
+                      name='get_game_stats',
+                      http_method='GET')
+    @instrumented
+    def get_game_stats(self, request):
+        """Returns global game statistics, refreshed about once a minute"""
+        return gamestats.get_stats_form()
+
+    @endpoints.method(request_message=JoinQueueForm,
+                      response_message=MatchForm,
+                      path='queue',
+                      name='join_queue',
+                      http_method='POST')
+    @instrumented
+    def join_queue(self, request):
+        """Puts the user in the matchmaking queue for a game of the variant
+        (classic by default) against a player of a similar rating. Poll
+        poll_match for the game"""
+        user = usernames.get_user(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        if user.name == ai.COMPUTER_NAME:
+            raise endpoints.BadRequestException(
+                'The computer cannot join the queue')
+        entry = matchmaking.join(user, _geometry(request))
+        return MatchForm(user_name=user.name, waiting=entry.waiting,
+                         variant=entry.variant,
+                         urlsafe_game_key=entry.game.urlsafe()
+                         if entry.game else None)
+
+    @endpoints.method(request_message=POLL_MATCH_REQUEST,
+                      response_message=MatchForm,
+                      path='queue/{user_name}',
+                      name='poll_match',
+                      http_method='GET')
+    @instrumented
+    def poll_match(self, request):
+        """Returns the game the user was matched into, waiting up to
+        wait_seconds (at most 20) for the match to be made"""
+        user_key = usernames.get_user_keys([request.user_name]).get(
+            request.user_name)
+        if not user_key:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        wait = max(0, min(request.wait_seconds or 0, MAX_POLL_SECONDS))
+        try:
+            game_key = matchmaking.poll(user_key, wait)
+        except KeyError:
+            raise endpoints.NotFoundException('User is not in the queue')
+        return MatchForm(user_name=request.user_name,
+                         waiting=game_key is None,
+                         urlsafe_game_key=game_key.urlsafe()
+                         if game_key else None)
+
+    @endpoints.method(request_message=NewTournamentForm,
+                      response_message=TournamentForm,
+                      path='tournament',
+                      name='create_tournament',
+                      http_method='POST')
+    @instrumented
+    def create_tournament(self, request):
+        """Creates a round robin or single elimination tournament between
+        the users, in seed order, and the games of its first round. Later
+        rounds are created as the previous one ends"""
+        geometry = _geometry(request)
+        if len(request.user_names) > tournaments.MAX_PLAYERS:
+            raise endpoints.BadRequestException(
+                'At most {0} players'.format(tournaments.MAX_PLAYERS))
+        users = usernames.get_users(request.user_names)
+        missing = [name for name in request.user_names if name not in users]
+        if missing:
+            raise endpoints.NotFoundException(
+                'No Users named {0}'.format(', '.join(missing)))
+        if ai.COMPUTER_NAME in users:
+            raise endpoints.BadRequestException(
+                'The computer cannot play in tournaments')
+        try:
+            tournament = tournaments.create(
+                request.name, request.kind,
+                [users[name] for name in request.user_names], geometry)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        return tournament.to_form()
+
+    @endpoints.method(request_message=GET_TOURNAMENT_REQUEST,
+                      response_message=TournamentForm,
+                      path='tournament/{urlsafe_tournament_key}',
+                      name='get_tournament',
+                      http_method='GET')
+    @instrumented
+    def get_tournament(self, request):
+        """Returns the current round and, once finished, the champion of a
+        tournament"""
+        tournament = get_key_by_urlsafe(request.urlsafe_tournament_key,
+                                        Tournament).get()
+        if not tournament:
+            raise endpoints.NotFoundException('Tournament not found!')
+        return tournament.to_form()
+
+    @endpoints.method(request_message=STANDINGS_REQUEST,
+                      response_message=StandingForms,
+                      path='tournament/{urlsafe_tournament_key}/standings',
+                      name='get_tournament_standings',
+                      http_method='GET')
+    @instrumented
+    def get_tournament_standings(self, request):
+        """Returns a page of a tournament's standings, by match points (2
+        per win, 1 per tie) then game points. Pass the returned next_cursor
+        to get the following page"""
+        tournament_key = get_key_by_urlsafe(request.urlsafe_tournament_key,
+                                            Tournament)
+        page_size = max(1, min(request.page_size or
+                               DEFAULT_STANDINGS_PAGE_SIZE,
+                               MAX_STANDINGS_PAGE_SIZE))
+        standings, cursor, more = tournaments.standings_page(
+            tournament_key, page_size, get_cursor(request.cursor))
+        return StandingForms(items=[standing.to_form()
+                                    for standing in standings],
+                             next_cursor=next_cursor(cursor, more))
+
+
+def _computer_user():
+    """Returns the User the computer plays as, creating it on first use.
+    It has no UserStats, so it never shows up in the rankings."""
+    return (usernames.get_user(ai.COMPUTER_NAME) or
+            usernames.create_user(ai.COMPUTER_NAME, stats=False) or
+            usernames.get_user(ai.COMPUTER_NAME))
+
+
+def _check_batch_size(items):
+    if len(items) > MAX_BATCH_SIZE:
+        raise endpoints.BadRequestException(
+            'At most {0} operations per batch'.format(MAX_BATCH_SIZE))
+
+
+def _geometry(form):
+    """Returns the engine Geometry of the variant asked for in a
+    NewGameForm or JoinQueueForm"""
+    try:
+        return engine.get_geometry(form.width, form.height, form.win_length)
+    except ValueError as e:
+        raise endpoints.BadRequestException(str(e))
+
+
+def _position_after(packed_moves, geometry):
+    """Returns (position, mask) for the player to move after the packed
+    moves. Raises an endpoints exception if a move can't be played or the
+    game is already over."""
+    board = engine.Board(geometry=geometry)
+    try:
+        for number, move in enumerate(unpack_moves(packed_moves)):
+            chip = 1 if number % 2 == 0 else 2
+            board.drop(ord(move), chip)
+            if board.has_won(chip):
+                raise endpoints.ConflictException('Game already over!')
+    except ValueError:
+        raise endpoints.BadRequestException('moves is not a playable game')
+    to_move = len(packed_moves) % 2
+    return board.bitboards[to_move], board.mask
+
+
+@timed_call('game_logic')
+def _play_move(game, user, column, entities, request_id=None):
+    """Drops the user's chip into the column of the game in memory and returns
+    the message for the player. Raises an endpoints exception if the move is
+    not allowed. A move whose request_id was already applied changes
+    nothing."""
+    if request_id and request_id in game.recent_requests:
+        return 'Move already applied'
+    if game.game_over:
+        raise endpoints.ConflictException('Game already over!')
+
+    # handle all incorrect turn attempts or users not in the game
+    if game.player_1_turn and user.key != game.user1:
+        if user.key != game.user2:
+            raise endpoints.NotFoundException(
+                'User not in this game')
+        else:
+            raise endpoints.ConflictException(
+                'Not your turn')
+    elif not game.player_1_turn and user.key != game.user2:
+        if user.key != game.user1:
+            raise endpoints.NotFoundException(
+                'User not in this game')
+        else:
+            raise endpoints.ConflictException(
+                'Not your turn')
+
+    # Make sure user picked a valid column.
+    if column < 0 or column >= game.width:
+        raise endpoints.BadRequestException(
+            'Must select a column between 0 and {0}'.format(game.width - 1))
+
+    try:
+        game.drop_chip(column)
+    except ValueError:
+        raise endpoints.ConflictException(
+            'column is already full, pick another')
+    game.record_move(column, request_id)
+
+    if game.has_last_chip_won():
+        # Player just won, end game accordingly
+        game.finish(user.key)
+        return "Player {0} just won!".format(user.name)
+    elif game.spaces_left() == 0:
+        # there are no open spaces, tie game
+        game.finish()
+        return "Game over, all spaces filled.  There are no winners here."
+    else:
+        # normal turn, next players turn.
+        game.player_1_turn = not game.player_1_turn
+        if game.player_1_turn:
+            return 'Player {0} is up next'.format(
+                entities.get(game.user1).name)
+        else:
+            return 'Player {0} is up next'.format(
+                entities.get(game.user2).name)
+
+
+def _play_turn(game, user, column, entities, request_id=None):
+    """_play_move, followed by the computer's reply in a game against the
+    computer"""
+    msg = _play_move(game, user, column, entities, request_id)
+    if game.vs_computer and not game.game_over and not game.player_1_turn:
+        reply = ai.choose_game_move(game, ai.DEFAULT_TIME_BUDGET)[0]
+        msg = 'Computer played column {0}. {1}'.format(
+            reply, _play_move(game, entities.get(game.user2), reply,
+                              entities))
+    return msg
+
+
+def _parse_date(value, name):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise endpoints.BadRequestException(
+            '{0} must be a date formatted YYYY-MM-DD'.format(name))
+
+
+def _scores_page(query, request, entities):
+    """Applies the won/date filters of a scores request to the query and
+    returns one page of it as ScoreForms"""
+    if request.won is not None:
+        query = query.filter(Score.won == request.won)
+    date_from = _parse_date(request.date_from, 'date_from')
+    if date_from:
+        query = query.filter(Score.date >= date_from)
+    date_to = _parse_date(request.date_to, 'date_to')
+    if date_to:
+        query = query.filter(Score.date <= date_to)
+    page_size = max(1, min(request.page_size or DEFAULT_SCORES_PAGE_SIZE,
+                           MAX_SCORES_PAGE_SIZE))
+    scores, cursor, more = query.order(-Score.date).fetch_page(
+        page_size, start_cursor=get_cursor(request.cursor))
+    entities.prefetch([key for score in scores for key in score.user_keys()])
+    return ScoreForms(items=[score.to_form(entities) for score in scores],
+                      next_cursor=next_cursor(cursor, more))
 
 
 api = endpoints.api_server([Connect4Api])
@@ -0,0 +1,63 @@
+"""archive.py - Compaction of old games into ArchivedGame entities.
+
+Finished games that haven't been saved for ARCHIVE_AFTER_DAYS are replaced
+by an ArchivedGame with the same id, holding the packed moves and outcome,
+and open games nobody has played for ABANDON_AFTER_DAYS are archived as
+expired.  Games stored before updated existed are only found once
+backfill.py's upgrade_games job has saved them.  Each game is archived in
+its own transaction, which gives up if the game was saved since it was
+read, and its cached copy is evicted once the archive commits.  gamecache
+reads archived games through, so get_game and get_game_history keep
+working on them.
+main.py runs archive_page page by page from a daily cron."""
+
+from datetime import datetime, timedelta
+
+from google.appengine.ext import ndb
+
+import gamecache
+import gamestats
+from models import ArchivedGame, Game
+
+ARCHIVE_AFTER_DAYS = 7
+ABANDON_AFTER_DAYS = 30
+ARCHIVE_BATCH_SIZE = 200
+
+
+def archive_page(expire_open, cursor=None):
+    """Archives one page of finished games, or with expire_open of abandoned
+    open games, and returns (cursor, more) for the next page"""
+    days = ABANDON_AFTER_DAYS if expire_open else ARCHIVE_AFTER_DAYS
+    cutoff = datetime.now() - timedelta(days=days)
+    keys, cursor, more = Game.query(
+        Game.open == expire_open, Game.updated < cutoff).fetch_page(
+            ARCHIVE_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+    # The index may be behind the entities.
+    games = [game for game in ndb.get_multi(keys)
+             if game and game.open == expire_open and game.updated < cutoff]
+    if expire_open:
+        # A tournament game has to be finished for its round to end.
+        games = [game for game in games if not game.tournament]
+        # A game with moves waiting in the cache is still being played.
+        live = gamecache.overlay_async(games).get_result()
+        games = [game for game, cached in zip(games, live) if cached is game]
+    archived = 0
+    for game in games:
+        if _archive(game, expire_open):
+            gamecache.evict(game.key)
+            archived += 1
+    if expire_open and archived:
+        gamestats.record(games_cancelled=archived)
+    return cursor, more
+
+
+@ndb.transactional(xg=True)
+def _archive(game, expired):
+    """Replaces the game with its ArchivedGame unless it was saved or
+    deleted since it was read. Returns True if it was archived."""
+    stored = game.key.get()
+    if stored is None or stored.version != game.version:
+        return False
+    ArchivedGame.from_game(stored, expired=expired).put()
+    game.key.delete()
+    return True
@@ -0,0 +1,165 @@
+"""backfill.py - One-off jobs bringing entities stored before a schema
+change up to date.
+
+Each job processes one page of entities and returns (cursor, more) for the
+next; main.py runs them page by page with a JobCheckpoint, started by an
+admin at /admin/backfill?job=<name>&start=1.  Running a job again is
+harmless, so a run that dies part way can simply be resumed or restarted.
+
+upgrade_games stores every Game that predates the players/open fields with
+them filled in, so open games reach get_user_games and the reminders, and
+finished ones stop reading as open.  It also saves games without an
+updated time, which archive.py could otherwise never select; they become
+due for archiving ARCHIVE_AFTER_DAYS after the backfill.
+
+user_stats rebuilds each User's UserStats from their Scores, so games
+finished before stats were kept count in the rankings.  It deletes the
+computer player's stats, which it no longer keeps.
+
+score_players fills in players on Scores recorded before it existed, which
+get_user_scores filters on; until it has run those Scores are missing from
+a user's score history.
+
+user_names reserves the normalized name of every User created before
+UserName reservations existed, so name lookups find them.  Users whose
+names normalize to one already reserved by another User are logged; they
+can only be reached by key until renamed."""
+
+import logging
+
+from google.appengine.ext import ndb
+
+import ai
+from models import Game, Score, User, UserName, UserStats
+from usernames import normalize
+
+BACKFILL_BATCH_SIZE = 100
+
+
+def _needs_upgrade(game):
+    return not game.players or game.updated is None
+
+
+@ndb.transactional
+def _upgrade_game(game_key):
+    # Re-read in the transaction so a move saved meanwhile is not lost.
+    game = game_key.get()
+    if game is None or not _needs_upgrade(game):
+        return
+    game.upgrade()
+    game.put()
+
+
+def upgrade_games_page(cursor=None):
+    """Upgrades one page of legacy games and returns (cursor, more)"""
+    keys, cursor, more = Game.query().fetch_page(
+        BACKFILL_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+    for game in ndb.get_multi(keys):
+        if game and _needs_upgrade(game):
+            _upgrade_game(game.key)
+    return cursor, more
+
+
+@ndb.tasklet
+def _tally_async(user_key):
+    """Tasklet returning (wins, losses, ties, points) over a user's Scores.
+    Queries by winner and loser also find Scores without players."""
+    totals = [0, 0, 0, 0]
+
+    def won(score):
+        if score.won:
+            totals[0] += 1
+            totals[3] += score.points
+        else:
+            totals[2] += 1
+
+    def lost(score):
+        if score.won:
+            totals[1] += 1
+        else:
+            totals[2] += 1
+
+    yield (Score.query(Score.winner == user_key).map_async(won),
+           Score.query(Score.loser == user_key).map_async(lost))
+    raise ndb.Return(totals)
+
+
+@ndb.transactional
+def _store_stats(user, games_seen, totals):
+    """Writes the rebuilt stats unless a game ended since they were
+    tallied, or the tally missed Scores the stats already count. Returns
+    True if they were written."""
+    stats = UserStats.key_for(user.key).get()
+    games = stats.games if stats else 0
+    if games != games_seen or sum(totals[:3]) < games:
+        return False
+    stats = stats or UserStats.for_user(user)
+    stats.wins, stats.losses, stats.ties, stats.points = totals
+    stats.win_percent = (stats.wins / float(stats.games)
+                         if stats.games else 0.0)
+    stats.put()
+    return True
+
+
+def user_stats_page(cursor=None):
+    """Rebuilds the UserStats of one page of users and returns (cursor,
+    more)"""
+    users, cursor, more = User.query().fetch_page(BACKFILL_BATCH_SIZE,
+                                                  start_cursor=cursor)
+    computer = [user for user in users if user.name == ai.COMPUTER_NAME]
+    ndb.delete_multi([UserStats.key_for(user.key) for user in computer])
+    users = [user for user in users if user.name != ai.COMPUTER_NAME]
+    stats = ndb.get_multi([UserStats.key_for(user.key) for user in users])
+    tallies = [_tally_async(user.key) for user in users]
+    for user, stat, tally in zip(users, stats, tallies):
+        if not _store_stats(user, stat.games if stat else 0,
+                            tally.get_result()):
+            logging.warning('Stats of %s changed while rebuilding; run the '
+                            'job again', user.name)
+    return cursor, more
+
+
+def score_players_page(cursor=None):
+    """Fills in players on one page of Scores and returns (cursor, more).
+    Scores never change once written, so no transaction is needed."""
+    keys, cursor, more = Score.query().fetch_page(
+        BACKFILL_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+    scores = [score for score in ndb.get_multi(keys)
+              if score and not score.players]
+    for score in scores:
+        score.players = [score.winner, score.loser]
+    ndb.put_multi(scores)
+    return cursor, more
+
+
+@ndb.transactional
+def _reserve_name(user):
+    """Reserves the user's normalized name unless it is taken, and returns
+    the key of the User holding it"""
+    reservation = UserName.get_by_id(normalize(user.name))
+    if reservation:
+        return reservation.user
+    UserName(id=normalize(user.name), user=user.key).put()
+    return user.key
+
+
+def user_names_page(cursor=None):
+    """Reserves the names of one page of users and returns (cursor, more)"""
+    users, cursor, more = User.query().fetch_page(BACKFILL_BATCH_SIZE,
+                                                  start_cursor=cursor)
+    for user in users:
+        if not normalize(user.name):
+            logging.warning('User %s has a blank name', user.key.id())
+            continue
+        holder = _reserve_name(user)
+        if holder != user.key:
+            logging.warning('Name %r of user %s is reserved by user %s',
+                            user.name, user.key.id(), holder.id())
+    return cursor, more
+
+
+# Job name to page function.
+JOBS = {'upgrade_games': upgrade_games_page,
+        'user_stats': user_stats_page,
+        'score_players': score_players_page,
+        'user_names': user_names_page}
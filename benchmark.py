@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+"""benchmark.py - Local benchmark and load generator for Connect4Api.
+
+Runs the API methods directly against the App Engine testbed stubs
+(datastore, memcache, taskqueue, mail) and reports, per endpoint, the number
+of calls, throughput, p50/p99 latency, datastore RPCs per call by type and
+the datastore bytes read and written per call.  Also times the win check and
+Game.to_form in isolation.
+
+Needs the App Engine Python SDK, e.g.:
+    python benchmark.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        --games 2000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import timeit
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def setup_sdk(sdk_path):
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class RpcRecorder(object):
+
+    """Counts the RPCs made while an endpoint call is being timed"""
+    def __init__(self):
+        self.current = None
+        self.calls = defaultdict(lambda: defaultdict(int))
+
+    def hook(self, service, call, request, response, rpc=None, error=None):
+        if self.current is None:
+            return
+        stats = self.calls[self.current]
+        stats['{0}.{1}'.format(service, call)] += 1
+        if service == 'datastore_v3':
+            if call in ('Put', 'Commit'):
+                stats['bytes_written'] += request.ByteSize()
+            elif call in ('Get', 'RunQuery', 'Next'):
+                stats['bytes_read'] += response.ByteSize()
+
+
+class Benchmark(object):
+
+    def __init__(self, users, games, seed):
+        from google.appengine.api import apiproxy_stub_map
+        import api
+        import mailer
+
+        self.api_module = api
+        self.service = api.Connect4Api()
+        self.users = ['bench_user_{0}'.format(i) for i in range(users)]
+        self.game_count = games
+        self.random = random.Random(seed)
+        self.latencies = defaultdict(list)
+        self.recorder = RpcRecorder()
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'benchmark', self.recorder.hook)
+        mailer.set_backend(mailer.StubMailBackend())
+
+    def call(self, name, request):
+        import endpoints
+        self.recorder.current = name
+        start = time.time()
+        try:
+            return getattr(self.service, name)(request)
+        except endpoints.ServiceException:
+            return None
+        finally:
+            self.latencies[name].append(time.time() - start)
+            self.recorder.current = None
+
+    def request(self, container, **fields):
+        return container.combined_message_class(**fields)
+
+    def run(self):
+        api = self.api_module
+        started = time.time()
+        for name in self.users:
+            self.call('create_user', self.request(
+                api.USER_REQUEST, user_name=name,
+                email='{0}@example.com'.format(name)))
+
+        games = []
+        for _ in range(self.game_count):
+            user1, user2 = self.random.sample(self.users, 2)
+            form = self.call('new_game', self.request(
+                api.NEW_GAME_REQUEST, user_1=user1, user_2=user2))
+            games.append([form.urlsafe_key, (user1, user2), 0])
+
+        # Interleave one move per live game per round, like many concurrent
+        # matches, with reads mixed in.
+        live = list(games)
+        while live:
+            self.random.shuffle(live)
+            still_live = []
+            for game in live:
+                key, players, turn = game
+                form = self.call('make_move', self.request(
+                    api.MAKE_MOVE_REQUEST, urlsafe_game_key=key,
+                    user=players[turn % 2],
+                    column=self.random.randint(0, 6)))
+                if form is None:
+                    # Full column, try another one next round.
+                    still_live.append(game)
+                    continue
+                game[2] += 1
+                if not form.game_over:
+                    still_live.append(game)
+                if self.random.random() < 0.3:
+                    self.call('get_game', self.request(
+                        api.GET_GAME_REQUEST, urlsafe_game_key=key))
+            live = still_live
+            self.call('get_scores', self.request(api.SCORES_REQUEST))
+            self.call('get_user_rankings', self.request(api.USER_RANKINGS))
+        return time.time() - started
+
+    def report(self, elapsed):
+        print('Total {0:.1f}s for {1} games\n'.format(elapsed,
+                                                     self.game_count))
+        header = '{0:<20}{1:>8}{2:>10}{3:>10}{4:>10}{5:>12}{6:>12}'
+        print(header.format('endpoint', 'calls', 'calls/s', 'p50 ms',
+                            'p99 ms', 'read B/call', 'write B/call'))
+        for name in sorted(self.latencies):
+            samples = self.latencies[name]
+            stats = self.recorder.calls[name]
+            print(header.format(
+                name, len(samples),
+                '{0:.0f}'.format(len(samples) / (sum(samples) or 1)),
+                '{0:.2f}'.format(percentile(samples, 0.5) * 1000),
+                '{0:.2f}'.format(percentile(samples, 0.99) * 1000),
+                stats['bytes_read'] // len(samples),
+                stats['bytes_written'] // len(samples)))
+        print('\nRPCs per call')
+        for name in sorted(self.latencies):
+            stats = self.recorder.calls[name]
+            rpcs = ', '.join(
+                '{0}={1:.2f}'.format(rpc, count / float(
+                    len(self.latencies[name])))
+                for rpc, count in sorted(stats.items())
+                if not rpc.startswith('bytes_'))
+            print('  {0:<20}{1}'.format(name, rpcs))
+
+
+def micro_benchmarks(number):
+    """Times the win check and form building on an in-memory game"""
+    from google.appengine.ext import ndb
+    from models import Game, User
+    import utils
+
+    user1, user2 = ndb.Key(User, 1), ndb.Key(User, 2)
+    game = Game(key=ndb.Key(Game, 1), user1=user1, user2=user2,
+                players=[user1, user2])
+    for column in (3, 3, 4, 2, 4, 5, 2, 2, 5, 1):
+        game.drop_chip(column)
+        game.player_1_turn = not game.player_1_turn
+    entities = utils.EntityMap()
+    entities.add(User(key=user1, name='one'))
+    entities.add(User(key=user2, name='two'))
+
+    print('\nMicro benchmarks ({0} runs)'.format(number))
+    for name, func in (
+            ('has_last_chip_won', game.has_last_chip_won),
+            ('spaces_left', game.spaces_left),
+            ('Game.to_form', lambda: game.to_form('bench', entities))):
+        seconds = timeit.timeit(func, number=number)
+        print('  {0:<20}{1:.2f} us/call'.format(name,
+                                               seconds / number * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='Path to the App Engine SDK')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--micro-runs', type=int, default=20000)
+    args = parser.parse_args()
+
+    setup_sdk(args.sdk)
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+        PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_app_identity_stub()
+    bed.init_mail_stub()
+    bed.init_urlfetch_stub()
+    try:
+        bench = Benchmark(args.users, args.games, args.seed)
+        bench.report(bench.run())
+        micro_benchmarks(args.micro_runs)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""book.py - Precomputed opening book and solved endgame positions.
+
+The book is a read-only file built offline by build_book.py for one variant
+and memory mapped when this module is first imported, so every request on
+the instance shares the same pages.  It is an open addressing hash table of
+fixed size records, so a lookup reads one record or a few neighbours.
+Positions are keyed canonically: a position and its mirror image share a
+record, and the column of a mirrored hit is mirrored back.
+
+File layout: an 8 byte header (magic, width, height, win length, log2 of the
+slot count) followed by the slots, each a RECORD of the position key plus
+one (0 for an empty slot), the value for the side to move, the best column
+and the search depth, SOLVED for positions searched to the end."""
+
+import os
+import struct
+from collections import namedtuple
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+import engine
+
+BOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'book.bin')
+MAGIC = 'C4BK'
+HEADER = struct.Struct('>4sBBBB')
+RECORD = struct.Struct('>QhBB')
+SOLVED = 255
+MAX_KEY = (1 << 64) - 2
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+_MASK64 = (1 << 64) - 1
+
+
+class Entry(namedtuple('Entry', 'column score depth')):
+
+    """A book position: best column and value for the side to move"""
+    @property
+    def solved(self):
+        return self.depth == SOLVED
+
+    def search_depth(self, mask, geometry=engine.CLASSIC):
+        """Returns the depth searched, the cells left for a solved
+        position rather than the SOLVED marker"""
+        if self.solved:
+            return geometry.cells - engine.popcount(mask)
+        return self.depth
+
+
+def canonical_key(geometry, position, mask):
+    """Returns (key, mirrored) for a position: the smaller of the keys of
+    the position and its mirror image, and whether that was the mirror"""
+    key = position + mask
+    mirrored = geometry.mirror(position) + geometry.mirror(mask)
+    if mirrored < key:
+        return mirrored, True
+    return key, False
+
+
+def _slot(key, bits):
+    return ((key * _HASH_MULTIPLIER) & _MASK64) >> (64 - bits)
+
+
+class Book(object):
+
+    def __init__(self, data):
+        magic, width, height, win_length, bits = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a position book')
+        self.geometry = engine.get_geometry(width, height, win_length)
+        self.bits = bits
+        self._data = data
+
+    def lookup(self, position, mask, geometry=engine.CLASSIC):
+        """Returns the Entry of a position of the book's variant, or None"""
+        if geometry is not self.geometry:
+            return None
+        key, mirrored = canonical_key(geometry, position, mask)
+        if key > MAX_KEY:
+            return None
+        index = _slot(key, self.bits)
+        while True:
+            stored, score, column, depth = RECORD.unpack_from(
+                self._data, HEADER.size + index * RECORD.size)
+            if stored == 0:
+                return None
+            if stored == key + 1:
+                if mirrored:
+                    column = geometry.width - 1 - column
+                return Entry(column, score, depth)
+            index = (index + 1) & ((1 << self.bits) - 1)
+
+
+def write(path, geometry, entries):
+    """Writes a book file from a dict of canonical key to Entry, with the
+    table at most half full"""
+    bits = max(4, (2 * len(entries)).bit_length())
+    data = bytearray(HEADER.size + (RECORD.size << bits))
+    HEADER.pack_into(data, 0, MAGIC, geometry.width, geometry.height,
+                     geometry.win_length, bits)
+    for key, entry in entries.items():
+        if key > MAX_KEY:
+            raise ValueError('Board too big for a book')
+        index = _slot(key, bits)
+        while RECORD.unpack_from(data, HEADER.size + index * RECORD.size)[0]:
+            index = (index + 1) & ((1 << bits) - 1)
+        RECORD.pack_into(data, HEADER.size + index * RECORD.size, key + 1,
+                         entry.score, entry.column, entry.depth)
+    with open(path, 'wb') as book_file:
+        book_file.write(data)
+
+
+def load(path=BOOK_PATH):
+    """Returns the Book in the file, memory mapped where the runtime allows
+    and read in otherwise, or None if no book was built"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as book_file:
+        try:
+            data = mmap.mmap(book_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            data = book_file.read()
+    return Book(data)
+
+
+_book = load()
+
+
+def lookup(position, mask, geometry=engine.CLASSIC):
+    """Returns the book Entry of a position, or None"""
+    return _book.lookup(position, mask, geometry) if _book else None
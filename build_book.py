@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""build_book.py - Builds the position book read by book.py.
+
+Searches every position of the first --plies moves to --depth, and solves
+--endgames positions with --endgame-empty empty cells reached by random
+play, storing each under its canonical (mirror-symmetric) key.  Positions
+that are already decided are left out.  The result goes to book.bin, which
+is deployed with the app.
+
+Needs the App Engine Python SDK, e.g.:
+    python build_book.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        --plies 6 --depth 12
+"""
+
+import argparse
+import random
+import time
+
+from benchmark import setup_sdk
+
+
+def opening_positions(geometry, plies):
+    """Yields (position, mask) for every undecided position of fewer than
+    plies moves, with position the side to move's chips"""
+    seen = set()
+    frontier = [(0, 0)]
+    for _ in range(plies):
+        following = []
+        for position, mask in frontier:
+            key = min(position + mask,
+                      geometry.mirror(position) + geometry.mirror(mask))
+            if key in seen:
+                continue
+            seen.add(key)
+            yield position, mask
+            for col in range(geometry.width):
+                if mask & geometry.top_bit(col):
+                    continue
+                move = (mask + geometry.bottom_bit(col)) & \
+                    geometry.column_mask(col)
+                if geometry.is_win(position | move):
+                    continue
+                following.append((position ^ mask, mask | move))
+        frontier = following
+
+
+def endgame_positions(geometry, count, empty, rng):
+    """Yields count undecided positions with empty cells left, reached by
+    random play"""
+    import engine
+    produced = 0
+    while produced < count:
+        board = engine.Board(geometry=geometry)
+        chip = 1
+        while board.spaces_left() > empty:
+            board.drop(rng.choice([col for col in range(geometry.width)
+                                   if board.can_drop(col)]), chip)
+            if board.has_won(chip):
+                break
+            chip = 3 - chip
+        else:
+            produced += 1
+            yield board.bitboards[chip - 1], board.mask
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='Path to the App Engine SDK')
+    parser.add_argument('--plies', type=int, default=6)
+    parser.add_argument('--depth', type=int, default=12)
+    parser.add_argument('--endgames', type=int, default=2000)
+    parser.add_argument('--endgame-empty', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--width', type=int, default=7)
+    parser.add_argument('--height', type=int, default=7)
+    parser.add_argument('--win-length', type=int, default=4)
+    parser.add_argument('--out')
+    args = parser.parse_args()
+
+    setup_sdk(args.sdk)
+    import ai
+    import book
+    import engine
+
+    geometry = engine.get_geometry(args.width, args.height, args.win_length)
+    rng = random.Random(args.seed)
+    entries = {}
+    started = time.time()
+    for positions, depth in (
+            (opening_positions(geometry, args.plies), args.depth),
+            (endgame_positions(geometry, args.endgames, args.endgame_empty,
+                               rng), geometry.cells)):
+        for position, mask in positions:
+            key, mirrored = book.canonical_key(geometry, position, mask)
+            if key in entries:
+                continue
+            if mirrored:
+                position, mask = (geometry.mirror(position),
+                                  geometry.mirror(mask))
+            column, value, reached, _ = ai.analyse(position, mask, depth,
+                                                   geometry)
+            if ai.is_solved(value, reached, mask, geometry):
+                reached = book.SOLVED
+            entries[key] = book.Entry(column, value, reached)
+    book.write(args.out or book.BOOK_PATH, geometry, entries)
+    print('{0} positions in {1:.0f}s'.format(len(entries),
+                                             time.time() - started))
+
+
+if __name__ == '__main__':
+    main()
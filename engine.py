@@ -0,0 +1,190 @@
+"""engine.py - Bitboard implementation of the Connect Four board.
+
+Each player's chips are kept in their own integer bitboard.  A column takes
+height + 1 consecutive bits (bottom row first); the extra bit on top of each
+column is always empty so that shifting a bitboard can never carry a run of
+chips from the top of one column into the bottom of the next.  Python
+integers have no fixed width, so the same shift-and-mask win check works
+for any board size; the classic 7x7 board is 56 bits.
+
+The board dimensions and the number of chips in a row needed to win are a
+Geometry, shared between all boards of that variant."""
+
+WIDTH = 7
+HEIGHT = 7
+WIN_LENGTH = 4
+
+MIN_SIZE = 4
+MAX_SIZE = 20
+MIN_WIN_LENGTH = 3
+
+
+def popcount(bitboard):
+    """Returns the number of chips set on a bitboard."""
+    return bin(bitboard).count('1')
+
+
+class Geometry(object):
+
+    """Board dimensions and win length, with the masks and shifts derived
+    from them.  Use get_geometry() so each variant is only built once."""
+
+    def __init__(self, width, height, win_length):
+        if not (MIN_SIZE <= width <= MAX_SIZE and
+                MIN_SIZE <= height <= MAX_SIZE):
+            raise ValueError('Board sides must be between {0} and {1}'.format(
+                MIN_SIZE, MAX_SIZE))
+        if not MIN_WIN_LENGTH <= win_length <= max(width, height):
+            raise ValueError('Win length must be between {0} and {1}'.format(
+                MIN_WIN_LENGTH, max(width, height)))
+        self.width = width
+        self.height = height
+        self.win_length = win_length
+        self.cells = width * height
+        self.column_bits = height + 1
+        self.column_bits_mask = (1 << height) - 1
+        # Bit shift for one step along each line direction: vertical,
+        # horizontal, diagonal (/) and anti-diagonal (\).
+        self.directions = (1, self.column_bits, self.column_bits + 1,
+                           self.column_bits - 1)
+        # Every playable cell of the board, sentinel bits excluded.
+        self.board_mask = sum(self.column_mask(col) for col in range(width))
+        # Columns from the center out, the usual best move order.
+        self.center_order = sorted(range(width),
+                                   key=lambda col: abs(width // 2 - col))
+
+    def is_win(self, bitboard):
+        """Returns True if the bitboard holds win_length chips in a row in
+        any direction.  Runs are doubled at each step, so this takes
+        log2(win_length) shifts per direction."""
+        for shift in self.directions:
+            run, length = bitboard, 1
+            while length * 2 <= self.win_length:
+                run &= run >> (shift * length)
+                length *= 2
+            if length < self.win_length:
+                # Two overlapping runs of length cover the rest.
+                run &= run >> (shift * (self.win_length - length))
+            if run:
+                return True
+        return False
+
+    def bottom_bit(self, column):
+        return 1 << (column * self.column_bits)
+
+    def top_bit(self, column):
+        return 1 << (column * self.column_bits + self.height - 1)
+
+    def column_mask(self, column):
+        return self.column_bits_mask << (column * self.column_bits)
+
+    def mirror(self, bitboard):
+        """Returns the bitboard flipped left to right."""
+        mirrored = 0
+        for col in range(self.width):
+            column = (bitboard >> (col * self.column_bits)) & \
+                self.column_bits_mask
+            mirrored |= column << ((self.width - 1 - col) * self.column_bits)
+        return mirrored
+
+    def winning_spots(self, bitboard, mask):
+        """Returns a bitboard of the empty cells (mask holds both players'
+        chips) where one more chip would complete a line for the
+        bitboard's player."""
+        spots = 0
+        for shift in self.directions:
+            for gap in range(self.win_length):
+                line = self.board_mask
+                for step in range(self.win_length):
+                    offset = (step - gap) * shift
+                    if offset > 0:
+                        line &= bitboard >> offset
+                    elif offset < 0:
+                        line &= bitboard << -offset
+                spots |= line
+        return spots & self.board_mask & ~mask
+
+
+_geometries = {}
+
+
+def get_geometry(width=WIDTH, height=HEIGHT, win_length=WIN_LENGTH):
+    """Returns the Geometry of a variant. Raises ValueError if the sizes are
+    out of range."""
+    key = (width, height, win_length)
+    geometry = _geometries.get(key)
+    if geometry is None:
+        geometry = _geometries[key] = Geometry(width, height, win_length)
+    return geometry
+
+
+CLASSIC = get_geometry()
+
+
+class Board(object):
+
+    """Connect Four board stored as one bitboard per player plus the height
+    of each column."""
+
+    def __init__(self, player1=0, player2=0, geometry=CLASSIC):
+        self.geometry = geometry
+        self.bitboards = [player1, player2]
+        mask = player1 | player2
+        self.heights = [popcount(mask & geometry.column_mask(col))
+                        for col in range(geometry.width)]
+
+    @classmethod
+    def from_columns(cls, columns, geometry=CLASSIC):
+        """Builds a board from lists of chips (0 empty, 1 or 2 a player's
+        chip) indexed by column, then row from the bottom up."""
+        bitboards = [0, 0]
+        for col, rows in enumerate(columns):
+            for row, chip in enumerate(rows):
+                if chip:
+                    bitboards[chip - 1] |= \
+                        1 << (col * geometry.column_bits + row)
+        return cls(bitboards[0], bitboards[1], geometry)
+
+    @property
+    def mask(self):
+        return self.bitboards[0] | self.bitboards[1]
+
+    def can_drop(self, column):
+        return (0 <= column < self.geometry.width and
+                self.heights[column] < self.geometry.height)
+
+    def drop(self, column, chip):
+        """Drops a chip (1 or 2) into the lowest open row of the column and
+        returns that row.  Raises ValueError if the column is outside the
+        board or already full."""
+        if column < 0 or column >= self.geometry.width:
+            raise ValueError('Column out of range')
+        row = self.heights[column]
+        if row >= self.geometry.height:
+            raise ValueError('Column is full')
+        self.bitboards[chip - 1] |= \
+            1 << (column * self.geometry.column_bits + row)
+        self.heights[column] = row + 1
+        return row
+
+    def has_won(self, chip):
+        return self.geometry.is_win(self.bitboards[chip - 1])
+
+    def spaces_left(self):
+        return self.geometry.cells - popcount(self.mask)
+
+    def column(self, column):
+        """Returns the chips of a column as a list, bottom row first."""
+        bits = column * self.geometry.column_bits
+        player1 = self.bitboards[0] >> bits
+        player2 = self.bitboards[1] >> bits
+        return [1 if player1 >> row & 1 else 2 if player2 >> row & 1 else 0
+                for row in range(self.geometry.height)]
+
+    def columns(self):
+        return [self.column(col) for col in range(self.geometry.width)]
+
+    def packed(self):
+        """Returns the chips as a string of '0', '1' and '2', column by
+        column, each column bottom row first."""
+        return ''.join(str(chip) for rows in self.columns() for chip in rows)
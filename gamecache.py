@@ -0,0 +1,291 @@
+"""gamecache.py - Memcache copy of live games with write-behind to the
+datastore.
+
+Reads of a live game are served from memcache and moves are applied to the
+cached copy with compare-and-set, so two moves racing on the same game can
+never both apply to the same state.  The datastore copy is only rewritten
+every CHECKPOINT_MOVES moves, when the game ends, and by a flush task queued
+FLUSH_DELAY seconds after the first unsaved move.  Saves are transactional
+and checked against Game.version, so a late flush never overwrites newer
+moves and never brings back a cancelled game.  Cached games expire after
+IDLE_TIMEOUT seconds without a move, which is well after their flush task
+has run.  Games that were archived are read through from their ArchivedGame,
+so they still read as finished games.  Every move also publishes the game's
+move count and whether it is over, a few bytes that watchers poll instead of
+the game."""
+
+import logging
+import time
+
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import ndb
+
+import gamestats
+import tournaments
+from models import ArchivedGame
+
+MEMCACHE_GAME = 'GAME:{0}'
+# (move count, game over) of a game, published for watchers.
+MEMCACHE_GAME_STATE = 'GAMESTATE:{0}'
+WATCH_INTERVAL = 0.5
+CHECKPOINT_MOVES = 6
+FLUSH_DELAY = 60
+IDLE_TIMEOUT = 30 * 60
+CAS_RETRIES = 5
+
+
+class GameContentionError(Exception):
+
+    """Raised when a move keeps losing the compare-and-set race"""
+
+
+def _cache_key(game_key):
+    return MEMCACHE_GAME.format(game_key.urlsafe())
+
+
+def _state_key(game_key):
+    return MEMCACHE_GAME_STATE.format(game_key.urlsafe())
+
+
+def _state(game):
+    return game.move_count, game.game_over
+
+
+@ndb.tasklet
+def get_game_async(game_key):
+    """Tasklet returning the live game, from memcache when cached, otherwise
+    from the datastore (caching it). Returns None if the game does not
+    exist."""
+    ctx = ndb.get_context()
+    entry = yield ctx.memcache_get(_cache_key(game_key))
+    if entry is not None:
+        raise ndb.Return(entry[0])
+    game = yield load_async(game_key)
+    if game is not None:
+        yield (ctx.memcache_add(_cache_key(game_key), (game, 0),
+                                time=IDLE_TIMEOUT),
+               ctx.memcache_add(_state_key(game_key), _state(game),
+                                time=IDLE_TIMEOUT))
+    raise ndb.Return(game)
+
+
+def get_game(game_key):
+    return get_game_async(game_key).get_result()
+
+
+@ndb.tasklet
+def load_async(game_key):
+    """Tasklet returning the stored game, rebuilt from its ArchivedGame
+    once it was archived, or None"""
+    game = yield game_key.get_async()
+    if game is None:
+        archived = yield ndb.Key(ArchivedGame, game_key.id()).get_async()
+        if archived is not None:
+            game = archived.to_game()
+    raise ndb.Return(game)
+
+
+@ndb.tasklet
+def overlay_async(games):
+    """Tasklet returning the games with any newer cached copies swapped in,
+    for lists read from a datastore query"""
+    ctx = ndb.get_context()
+    entries = yield [ctx.memcache_get(_cache_key(game.key)) for game in games]
+    raise ndb.Return([entry[0] if entry is not None else game
+                      for game, entry in zip(games, entries)])
+
+
+def update_game(game_key, apply):
+    """Applies a move to the cached game with compare-and-set.
+
+    apply(game) mutates the game in memory only and returns a result; it is
+    called again on the fresh state if another request changed the game in
+    the meantime, and any exception it raises is passed on. The game is
+    saved to the datastore when it ends or reaches a checkpoint.
+    Returns:
+        (game, result), or None if the game does not exist.
+    Raises:
+        GameContentionError: if the game kept changing under the move."""
+    client = memcache.Client()
+    cache_key = _cache_key(game_key)
+    for _ in range(CAS_RETRIES):
+        entry = client.gets(cache_key)
+        if entry is None:
+            game = load_async(game_key).get_result()
+            if game is None:
+                return None
+            # Seed the cache, then go round again for a CAS id.
+            client.add(cache_key, (game, 0), time=IDLE_TIMEOUT)
+            continue
+        game, unsaved = entry
+        version = game.version
+        result = apply(game)
+        if game.version == version:
+            # Nothing changed (e.g. a replayed request), nothing to write.
+            return game, result
+        unsaved += 1
+        if not client.cas(cache_key, (game, unsaved), time=IDLE_TIMEOUT):
+            continue
+        _publish(client, game)
+        _write_behind(client, cache_key, game, unsaved)
+        return game, result
+    raise GameContentionError(game_key)
+
+
+def _write_behind(client, cache_key, game, unsaved):
+    """Saves a game that just changed in the cache if it ended or reached
+    a checkpoint, otherwise makes sure a flush task will save it"""
+    if game.game_over or unsaved >= CHECKPOINT_MOVES:
+        try:
+            save(game)
+        except Exception:
+            # Leave it to the flush task, which retries until it saves.
+            _enqueue_flush(game, countdown=0)
+            raise
+        _mark_saved(client, cache_key, game.version)
+    elif unsaved == 1:
+        _enqueue_flush(game)
+
+
+@ndb.transactional(xg=True)
+def save(game):
+    """Writes a cached game to the datastore unless the stored copy is
+    newer or was deleted. A game that just ended is saved in the same
+    transaction as its Score, the players' stats and the game counters.
+    Returns True if the game was written."""
+    stored = game.key.get()
+    if stored is None or stored.version > game.version:
+        return False
+    game.put()
+    if game.game_over and not stored.game_over:
+        game.record_score()
+        gamestats.game_finished(game, game.game_winner is not None)
+        tournaments.game_ended(game)
+    return True
+
+
+def _mark_saved(client, cache_key, version):
+    """Clears the unsaved move count if the cached game is still the saved
+    version"""
+    for _ in range(CAS_RETRIES):
+        entry = client.gets(cache_key)
+        if entry is None or entry[0].version != version:
+            return
+        if client.cas(cache_key, (entry[0], 0), time=IDLE_TIMEOUT):
+            return
+
+
+def update_games(updates):
+    """Batch form of update_game for many games at once.
+
+    updates maps game keys to apply functions as for update_game, except
+    that apply must not raise. Games are read with one get_multi and
+    compare-and-set with one cas_multi per round. Each changed game is then
+    saved or left to its flush task exactly as update_game would; a game
+    whose save fails keeps its unsaved moves in the cache and is flushed
+    by a task.
+    Returns:
+        A dict of game key to (game, result). Missing games are left out and
+        games that kept losing the race map to (None, GameContentionError).
+    """
+    client = memcache.Client()
+    cache_keys = dict((_cache_key(key), key) for key in updates)
+    results = {}
+    pending = set(cache_keys)
+    for _ in range(CAS_RETRIES):
+        if not pending:
+            break
+        entries = client.get_multi(list(pending), for_cas=True)
+        missing = [cache_keys[cache_key] for cache_key in pending
+                   if cache_key not in entries]
+        if missing:
+            loaded = [load.get_result()
+                      for load in [load_async(key) for key in missing]]
+            seed = dict((_cache_key(game.key), (game, 0))
+                        for game in loaded if game)
+            pending -= set(_cache_key(key) for key in missing) - set(seed)
+            client.add_multi(seed, time=IDLE_TIMEOUT)
+            continue
+        changed = {}
+        for cache_key, (game, unsaved) in entries.items():
+            version = game.version
+            results[cache_keys[cache_key]] = (
+                game, updates[cache_keys[cache_key]](game))
+            if game.version != version:
+                changed[cache_key] = (game, unsaved + 1)
+        pending = set(client.cas_multi(changed, time=IDLE_TIMEOUT))
+        for cache_key in changed:
+            if cache_key in pending:
+                continue
+            game, unsaved = changed[cache_key]
+            _publish(client, game)
+            try:
+                _write_behind(client, cache_key, game, unsaved)
+            except Exception:
+                # The move stands in the cache and the flush task saves it.
+                logging.exception('Saving game %s failed', game.key)
+    for cache_key in pending:
+        results[cache_keys[cache_key]] = (
+            None, GameContentionError(cache_keys[cache_key]))
+    return results
+
+
+def _publish(client, game):
+    """Raises the published state of a game to its current one. Moves can
+    finish out of order, so the state is only ever moved forward."""
+    state_key, state = _state_key(game.key), _state(game)
+    for _ in range(CAS_RETRIES):
+        published = client.gets(state_key)
+        if published is None:
+            if client.add(state_key, state, time=IDLE_TIMEOUT):
+                return
+        elif published >= state:
+            return
+        elif client.cas(state_key, state, time=IDLE_TIMEOUT):
+            return
+
+
+def wait_for_move(game_key, since_move, timeout):
+    """Waits up to timeout seconds for the game to have more than
+    since_move moves or to be over, polling only its published state while
+    the game is cached. Returns the last (move count, game over) seen, or
+    None if the game does not exist."""
+    client = memcache.Client()
+    deadline = time.time() + timeout
+    while True:
+        state = client.get(_state_key(game_key))
+        if state is None:
+            game = get_game(game_key)
+            if game is None:
+                return None
+            state = _state(game)
+            client.add(_state_key(game_key), state, time=IDLE_TIMEOUT)
+        if state[0] > since_move or state[1]:
+            return state
+        if time.time() + WATCH_INTERVAL > deadline:
+            return state
+        time.sleep(WATCH_INTERVAL)
+
+
+def _enqueue_flush(game, countdown=FLUSH_DELAY):
+    # Not named: a version comes round again when an evicted game is
+    # reloaded, and a tombstoned name would drop the new flush. flush()
+    # does nothing once the moves are saved, so extra tasks are harmless.
+    taskqueue.add(url='/tasks/flush_game',
+                  params={'urlsafe_game_key': game.key.urlsafe()},
+                  countdown=countdown)
+
+
+def flush(game_key):
+    """Saves unsaved moves of a cached game to the datastore. Raises if the
+    save fails so the task is retried."""
+    client = memcache.Client()
+    entry = client.gets(_cache_key(game_key))
+    if entry is None or entry[1] == 0:
+        return
+    save(entry[0])
+    _mark_saved(client, _cache_key(game_key), entry[0].version)
+
+
+def evict(game_key):
+    memcache.delete_multi([_cache_key(game_key), _state_key(game_key)])
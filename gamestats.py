@@ -0,0 +1,79 @@
+"""gamestats.py - Global game statistics kept as sharded counters.
+
+Game lifecycle events add to a random GameStatsShard in a small transaction.
+The derived statistics (active games, average moves and points per finished
+game, win and tie ratios) are recomputed from all shards by at most one task
+per RECOMPUTE_WINDOW seconds, however many events happened, and served from
+memcache."""
+
+import random
+import time
+
+from google.appengine.api import memcache, taskqueue
+from google.appengine.ext import ndb
+
+from models import GameStatsShard, GameStatsForm
+
+NUM_SHARDS = 20
+RECOMPUTE_WINDOW = 60
+MEMCACHE_GAME_STATS = 'GAME_STATS'
+COUNTERS = ('games_created', 'games_finished', 'games_won',
+            'games_cancelled', 'total_moves', 'total_points')
+
+
+def _shard_keys():
+    return [ndb.Key(GameStatsShard, 'shard-{0}'.format(index))
+            for index in range(NUM_SHARDS)]
+
+
+@ndb.transactional
+def _add_to_shard(key, deltas):
+    shard = key.get() or GameStatsShard(key=key)
+    for counter, delta in deltas.items():
+        setattr(shard, counter, getattr(shard, counter) + delta)
+    shard.put()
+
+
+def record(**deltas):
+    """Adds the deltas (keyword per counter in COUNTERS) to one shard and
+    makes sure a recompute is scheduled for the current window"""
+    _add_to_shard(random.choice(_shard_keys()), deltas)
+    window = int(time.time()) // RECOMPUTE_WINDOW
+    try:
+        taskqueue.add(url='/tasks/update_game_stats',
+                      name='game-stats-{0}'.format(window),
+                      countdown=RECOMPUTE_WINDOW)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def game_finished(game, won):
+    record(games_finished=1, games_won=1 if won else 0,
+           total_moves=game.move_count, total_points=game.spaces_left())
+
+
+def recompute():
+    """Sums all shards, caches the derived stats and returns them"""
+    totals = dict((counter, 0) for counter in COUNTERS)
+    for shard in ndb.get_multi(_shard_keys()):
+        if shard:
+            for counter in COUNTERS:
+                totals[counter] += getattr(shard, counter)
+    finished = totals['games_finished']
+    stats = {
+        'games_created': totals['games_created'],
+        'active_games': max(0, totals['games_created'] - finished -
+                            totals['games_cancelled']),
+        'finished_games': finished,
+        'average_moves': totals['total_moves'] / float(finished or 1),
+        'average_points': totals['total_points'] / float(finished or 1),
+        'win_ratio': totals['games_won'] / float(finished or 1),
+        'tie_ratio': (finished - totals['games_won']) / float(finished or 1),
+    }
+    memcache.set(MEMCACHE_GAME_STATS, stats)
+    return stats
+
+
+def get_stats_form():
+    stats = memcache.get(MEMCACHE_GAME_STATS) or recompute()
+    return GameStatsForm(**stats)
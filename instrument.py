@@ -0,0 +1,136 @@
+"""instrument.py - Per-request instrumentation of the API and task handlers.
+
+Handlers wrapped with instrumented() collect, for each request, the RPCs
+made by service and call, datastore bytes read and written, and the time
+spent in named sections (form serialization, game logic) marked with
+timed() or timed_call().  Each request is logged as one structured record
+and folded into a rolling in-memory aggregate per handler, which main.py
+serves to admins.  The aggregate is per instance."""
+
+import functools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+from google.appengine.api import apiproxy_stub_map
+
+# Latency samples kept per handler for the percentiles.
+WINDOW = 500
+
+_local = threading.local()
+_lock = threading.Lock()
+_aggregate = {}
+
+
+def _current():
+    return getattr(_local, 'stats', None)
+
+
+def _rpc_hook(service, call, request, response):
+    stats = _current()
+    if stats is None:
+        return
+    stats['rpc.{0}.{1}'.format(service, call)] += 1
+    if service == 'datastore_v3':
+        if call in ('Put', 'Commit'):
+            stats['bytes_written'] += request.ByteSize()
+        elif call in ('Get', 'RunQuery', 'Next'):
+            stats['bytes_read'] += response.ByteSize()
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'instrument', _rpc_hook)
+
+
+class timed(object):
+
+    """Context manager adding the time spent in its block to the named
+    section of the current request"""
+    def __init__(self, section):
+        self.section = section
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        stats = _current()
+        if stats is not None:
+            stats['ms.' + self.section] += (time.time() - self.start) * 1000
+
+
+def timed_call(section):
+    """Decorator form of timed"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(section):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrumented(func_or_name):
+    """Decorator collecting the stats of each call of a handler. Use it bare
+    on API methods, or with a name for webapp2 handler methods."""
+    def decorator(func, name):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current() is not None:
+                # Nested call, the outer handler already collects.
+                return func(*args, **kwargs)
+            _local.stats = defaultdict(float)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats = _local.stats
+                _local.stats = None
+                stats['ms.total'] = (time.time() - start) * 1000
+                _record(name, stats)
+        return wrapper
+
+    if callable(func_or_name):
+        return decorator(func_or_name, func_or_name.__name__)
+    return lambda func: decorator(func, func_or_name)
+
+
+def _record(name, stats):
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        logging.info('instrument %s', json.dumps(
+            dict(stats, handler=name), sort_keys=True))
+    with _lock:
+        entry = _aggregate.get(name)
+        if entry is None:
+            entry = _aggregate[name] = {'calls': 0,
+                                        'totals': defaultdict(float),
+                                        'latencies': deque(maxlen=WINDOW)}
+        entry['calls'] += 1
+        entry['latencies'].append(stats['ms.total'])
+        for stat, value in stats.items():
+            entry['totals'][stat] += value
+
+
+def snapshot():
+    """Returns the aggregate as a dict of handler name to call count,
+    p50/p99 latency over the last WINDOW calls and per-call averages"""
+    with _lock:
+        result = {}
+        for name, entry in _aggregate.items():
+            latencies = sorted(entry['latencies'])
+            result[name] = {
+                'calls': entry['calls'],
+                'p50_ms': latencies[len(latencies) // 2],
+                'p99_ms': latencies[min(len(latencies) - 1,
+                                        int(len(latencies) * 0.99))],
+                'per_call': dict((stat, total / entry['calls'])
+                                 for stat, total in
+                                 entry['totals'].items()),
+            }
+        return result
+
+
+def reset():
+    with _lock:
+        _aggregate.clear()
@@ -0,0 +1,38 @@
+"""mailer.py - Pluggable mail backend for the emails sent by the app.
+Handlers send through get_backend() so a local run or test can swap in the
+StubMailBackend with set_backend()."""
+
+from google.appengine.api import mail, app_identity
+
+
+class AppEngineMailBackend(object):
+
+    """Sends mail through the App Engine mail service"""
+    def send(self, to, subject, body):
+        sender = 'noreply@{}.appspotmail.com'.format(
+            app_identity.get_application_id())
+        mail.send_mail(sender, to, subject, body)
+
+
+class StubMailBackend(object):
+
+    """Keeps messages in an outbox instead of sending them"""
+    def __init__(self):
+        self.outbox = []
+
+    def send(self, to, subject, body):
+        self.outbox.append((to, subject, body))
+
+
+_backend = AppEngineMailBackend()
+
+
+def get_backend():
+    return _backend
+
+
+def set_backend(backend):
+    """Replaces the backend used by every handler, returns the old one"""
+    global _backend
+    previous, _backend = _backend, backend
+    return previous
@@ -2,38 +2,391 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import json
 import logging
 
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
 from api import Connect4Api
 from google.appengine.ext import ndb
 
-from models import User, Game
+import archive
+import backfill
+import gamecache
+import gamestats
+import instrument
+import mailer
+import matchmaking
+import replay
+import tournaments
+from instrument import instrumented
+from models import Game, JobCheckpoint, ReplayIssue
+from utils import get_cursor
+
+REMINDER_JOB = 'send_reminder'
+# Distinct players read per scan task and emailed per send task.
+REMINDER_BATCH_SIZE = 100
+REPLAY_JOB = 'replay_games'
+# Compaction jobs, and whether each expires open games.
+ARCHIVE_JOBS = {'archive_games': False, 'expire_games': True}
+# Game keys read per replay scan task and validated per batch task.
+REPLAY_BATCH_SIZE = 500
+# Issues listed by the replay status page.
+REPLAY_REPORT_SIZE = 100
+
+
+def enqueue_once(url, name, params):
+    """Adds a named task. The name makes the add idempotent, so a retried
+    or duplicated caller never enqueues the same work twice."""
+    try:
+        taskqueue.add(url=url, name=name, params=params)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        logging.info('Task %s already enqueued', name)
+
+
+def enqueue_reminder_scan(checkpoint):
+    enqueue_once('/tasks/reminder_scan',
+                 'reminder-scan-{0}-{1}'.format(checkpoint.run,
+                                                checkpoint.page),
+                 {'run': checkpoint.run, 'page': checkpoint.page})
+
+
+def enqueue_replay_scan(checkpoint, apply_fixes):
+    enqueue_once('/tasks/replay_scan',
+                 'replay-scan-{0}-{1}'.format(checkpoint.run, checkpoint.page),
+                 {'run': checkpoint.run, 'page': checkpoint.page,
+                  'fix': int(apply_fixes)})
+
+
+def enqueue_backfill_page(job, checkpoint):
+    enqueue_once('/tasks/backfill',
+                 'backfill-{0}-{1}-{2}'.format(job.replace('_', '-'),
+                                               checkpoint.run,
+                                               checkpoint.page),
+                 {'job': job, 'run': checkpoint.run,
+                  'page': checkpoint.page})
+
+
+def enqueue_archive_page(job, checkpoint):
+    enqueue_once('/tasks/archive_games',
+                 '{0}-{1}-{2}'.format(job.replace('_', '-'), checkpoint.run,
+                                      checkpoint.page),
+                 {'job': job, 'run': checkpoint.run,
+                  'page': checkpoint.page})
 
 
 class SendReminderEmail(webapp2.RequestHandler):
 
+    @instrumented('SendReminderEmail')
     def get(self):
         """Send a reminder email to each User with an email about games.
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
-        for user in users:
-            gamesOpen = Game.query(ndb.AND(ndb.OR(Game.user1 == user.key,
-                                                  Game.user2 == user.key),
-                                           Game.game_over == False))
-            if gamesOpen.count() > 0:
-                subject = 'This is a reminder!'
-                body = 'Hello {}.  Finish up your open Connect Four \
-                games!'.format(user.name)
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+        Called every 12 hours using a cron job. Starts a new run of the
+        reminder scan, or resumes the last one if it never finished"""
+        checkpoint = JobCheckpoint.get_or_insert(REMINDER_JOB)
+        if checkpoint.done:
+            checkpoint.run += 1
+            checkpoint.page = 0
+            checkpoint.cursor = None
+            checkpoint.done = False
+            checkpoint.put()
+        else:
+            logging.info('Resuming reminder run %d at page %d',
+                         checkpoint.run, checkpoint.page)
+        enqueue_reminder_scan(checkpoint)
+
+
+class ScanReminderPlayers(webapp2.RequestHandler):
+
+    @instrumented('ScanReminderPlayers')
+    def post(self):
+        """Reads one page of distinct players with open games, hands them to
+        a send task and checkpoints the cursor before chaining the next
+        page"""
+        run = int(self.request.get('run'))
+        page = int(self.request.get('page'))
+        checkpoint = JobCheckpoint.get_by_id(REMINDER_JOB)
+        if (not checkpoint or checkpoint.done or checkpoint.run != run or
+                checkpoint.page != page):
+            logging.info('Skipping stale reminder scan %d/%d', run, page)
+            return
+        # A distinct projection over the (open, players) index returns each
+        # player once per run, however many games they have open.
+        query = Game.query(Game.open == True, projection=[Game.players],
+                           distinct=True).order(Game.players)
+        games, cursor, more = query.fetch_page(
+            REMINDER_BATCH_SIZE, start_cursor=get_cursor(checkpoint.cursor))
+        checkpoint.page += 1
+        checkpoint.cursor = cursor.urlsafe() if cursor else None
+        checkpoint.done = not more
+        # Enqueue before checkpointing: if this fails the page is retried,
+        # and the task name stops a retry from sending it twice.
+        if games:
+            enqueue_once('/tasks/send_reminder_batch',
+                         'reminder-send-{0}-{1}'.format(run, page),
+                         {'users': ','.join(game.players[0].urlsafe()
+                                            for game in games)})
+        checkpoint.put()
+        if more:
+            enqueue_reminder_scan(checkpoint)
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+
+    @instrumented('SendReminderBatch')
+    def post(self):
+        """Emails one batch of players about their open games"""
+        keys = [ndb.Key(urlsafe=urlsafe)
+                for urlsafe in self.request.get('users').split(',')]
+        backend = mailer.get_backend()
+        for user in ndb.get_multi(keys):
+            if user is None or not user.email:
+                continue
+            subject = 'This is a reminder!'
+            body = 'Hello {}.  Finish up your open Connect Four \
+            games!'.format(user.name)
+            backend.send(user.email, subject, body)
+
+class FlushGame(webapp2.RequestHandler):
+
+    @instrumented('FlushGame')
+    def post(self):
+        """Writes the unsaved moves of a cached live game to the datastore"""
+        gamecache.flush(ndb.Key(urlsafe=self.request.get('urlsafe_game_key')))
+
+class UpdateGameStats(webapp2.RequestHandler):
+
+    @instrumented('UpdateGameStats')
+    def post(self):
+        """Recomputes the cached global game statistics from the counter
+        shards. Enqueued at most once per window by gamestats.record"""
+        gamestats.recompute()
+
+
+class CompactGames(webapp2.RequestHandler):
+
+    @instrumented('CompactGames')
+    def get(self):
+        """Archives old finished games and expires abandoned open ones.
+        Called daily by a cron job. Starts a new run of each job, or resumes
+        the last one if it never finished"""
+        for job in ARCHIVE_JOBS:
+            checkpoint = JobCheckpoint.get_or_insert(job)
+            if checkpoint.done:
+                checkpoint.run += 1
+                checkpoint.page = 0
+                checkpoint.cursor = None
+                checkpoint.done = False
+                checkpoint.put()
+            enqueue_archive_page(job, checkpoint)
+
+
+class ArchiveGames(webapp2.RequestHandler):
+
+    @instrumented('ArchiveGames')
+    def post(self):
+        """Archives one page of games for a compaction job and checkpoints
+        the cursor before chaining the next page"""
+        job = self.request.get('job')
+        run = int(self.request.get('run'))
+        page = int(self.request.get('page'))
+        checkpoint = JobCheckpoint.get_by_id(job)
+        if (job not in ARCHIVE_JOBS or not checkpoint or checkpoint.done or
+                checkpoint.run != run or checkpoint.page != page):
+            logging.info('Skipping stale %s page %d/%d', job, run, page)
+            return
+        cursor, more = archive.archive_page(ARCHIVE_JOBS[job],
+                                            get_cursor(checkpoint.cursor))
+        checkpoint.page += 1
+        checkpoint.cursor = cursor.urlsafe() if cursor else None
+        checkpoint.done = not more
+        checkpoint.put()
+        if more:
+            enqueue_archive_page(job, checkpoint)
+
+
+class MatchPlayers(webapp2.RequestHandler):
+
+    @instrumented('MatchPlayers')
+    def post(self):
+        """Pairs the players waiting in the matchmaking queue. Enqueued at
+        most once per window by matchmaking.join"""
+        matchmaking.pair_waiting()
+
+
+class TournamentResult(webapp2.RequestHandler):
+
+    @instrumented('TournamentResult')
+    def post(self):
+        """Records the result of a tournament game. Enqueued by
+        tournaments.game_ended when the game is saved as ended"""
+        tournaments.record_result(
+            ndb.Key(urlsafe=self.request.get('tournament')),
+            int(self.request.get('round')), int(self.request.get('slot')),
+            ndb.Key(urlsafe=self.request.get('user1')),
+            ndb.Key(urlsafe=self.request.get('user2')),
+            ndb.Key(urlsafe=self.request.get('winner'))
+            if self.request.get('winner') else None,
+            int(self.request.get('points')))
+
+
+class AdvanceTournament(webapp2.RequestHandler):
+
+    @instrumented('AdvanceTournament')
+    def post(self):
+        """Starts the next round of a tournament, or finishes it. Enqueued
+        once per round by the result that completes the previous one"""
+        tournaments.advance(ndb.Key(urlsafe=self.request.get('tournament')),
+                            int(self.request.get('round')))
+
+
+class ReplayGames(webapp2.RequestHandler):
+
+    def get(self):
+        """Returns the progress and the issues found by the latest replay
+        run as JSON. Pass start=1 to start a new run, or resume one that
+        never finished, and fix=1 with it to also correct what can be"""
+        checkpoint = JobCheckpoint.get_or_insert(REPLAY_JOB)
+        if self.request.get('start'):
+            if checkpoint.done:
+                checkpoint.run += 1
+                checkpoint.page = 0
+                checkpoint.cursor = None
+                checkpoint.done = False
+                checkpoint.put()
+            enqueue_replay_scan(checkpoint, self.request.get('fix') == '1')
+        issues = ReplayIssue.query(ReplayIssue.run == checkpoint.run)
+        report = {
+            'run': checkpoint.run,
+            'pages_scanned': checkpoint.page,
+            'done': checkpoint.done,
+            'games_with_problems': issues.count(),
+            'issues': [{'game': issue.game.urlsafe(),
+                        'problems': issue.problems,
+                        'fixed': issue.fixed}
+                       for issue in issues.fetch(REPLAY_REPORT_SIZE)],
+        }
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(report, indent=2, sort_keys=True))
+
+
+class Backfill(webapp2.RequestHandler):
+
+    def get(self):
+        """Returns the progress of a backfill job as JSON. Pass start=1 to
+        start a new run, or resume one that never finished"""
+        job = self.request.get('job')
+        if job not in backfill.JOBS:
+            self.abort(404, detail='Backfill jobs: {0}'.format(
+                ', '.join(sorted(backfill.JOBS))))
+        checkpoint = JobCheckpoint.get_or_insert('backfill_' + job)
+        if self.request.get('start'):
+            if checkpoint.done:
+                checkpoint.run += 1
+                checkpoint.page = 0
+                checkpoint.cursor = None
+                checkpoint.done = False
+                checkpoint.put()
+            enqueue_backfill_page(job, checkpoint)
+        report = {'job': job, 'run': checkpoint.run,
+                  'pages': checkpoint.page, 'done': checkpoint.done}
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(report, indent=2, sort_keys=True))
+
+
+class BackfillPage(webapp2.RequestHandler):
+
+    @instrumented('BackfillPage')
+    def post(self):
+        """Runs one page of a backfill job and checkpoints the cursor before
+        chaining the next page"""
+        job = self.request.get('job')
+        run = int(self.request.get('run'))
+        page = int(self.request.get('page'))
+        checkpoint = JobCheckpoint.get_by_id('backfill_' + job)
+        if (job not in backfill.JOBS or not checkpoint or checkpoint.done or
+                checkpoint.run != run or checkpoint.page != page):
+            logging.info('Skipping stale backfill %s page %d/%d', job, run,
+                         page)
+            return
+        cursor, more = backfill.JOBS[job](get_cursor(checkpoint.cursor))
+        checkpoint.page += 1
+        checkpoint.cursor = cursor.urlsafe() if cursor else None
+        checkpoint.done = not more
+        checkpoint.put()
+        if more:
+            enqueue_backfill_page(job, checkpoint)
+
+
+class ScanReplayGames(webapp2.RequestHandler):
+
+    @instrumented('ScanReplayGames')
+    def post(self):
+        """Reads one page of game keys, hands it to a batch task and
+        checkpoints the cursor before chaining the next page. The scan is
+        keys only, so it stays well ahead of the batches, which run in
+        parallel"""
+        run = int(self.request.get('run'))
+        page = int(self.request.get('page'))
+        apply_fixes = self.request.get('fix') == '1'
+        checkpoint = JobCheckpoint.get_by_id(REPLAY_JOB)
+        if (not checkpoint or checkpoint.done or checkpoint.run != run or
+                checkpoint.page != page):
+            logging.info('Skipping stale replay scan %d/%d', run, page)
+            return
+        keys, cursor, more = Game.query().fetch_page(
+            REPLAY_BATCH_SIZE, keys_only=True,
+            start_cursor=get_cursor(checkpoint.cursor))
+        checkpoint.page += 1
+        checkpoint.cursor = cursor.urlsafe() if cursor else None
+        checkpoint.done = not more
+        # As for reminders, the batch is enqueued before the checkpoint.
+        if keys:
+            enqueue_once('/tasks/replay_batch',
+                         'replay-batch-{0}-{1}'.format(run, page),
+                         {'run': run, 'fix': int(apply_fixes),
+                          'games': ','.join(key.urlsafe() for key in keys)})
+        checkpoint.put()
+        if more:
+            enqueue_replay_scan(checkpoint, apply_fixes)
+
+
+class ReplayBatch(webapp2.RequestHandler):
+
+    @instrumented('ReplayBatch')
+    def post(self):
+        """Replays and checks one batch of games"""
+        keys = [ndb.Key(urlsafe=urlsafe)
+                for urlsafe in self.request.get('games').split(',')]
+        replay.validate_batch(int(self.request.get('run')), keys,
+                              self.request.get('fix') == '1')
+
+
+class InstrumentationStats(webapp2.RequestHandler):
+
+    def get(self):
+        """Returns this instance's rolling per-handler stats as JSON. Pass
+        reset=1 to clear them"""
+        stats = instrument.snapshot()
+        if self.request.get('reset'):
+            instrument.reset()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats, indent=2, sort_keys=True))
 
 app = webapp2.WSGIApplication([
-    ('/crons/send_reminder', SendReminderEmail)
+    ('/crons/send_reminder', SendReminderEmail),
+    ('/crons/compact_games', CompactGames),
+    ('/tasks/archive_games', ArchiveGames),
+    ('/tasks/reminder_scan', ScanReminderPlayers),
+    ('/tasks/send_reminder_batch', SendReminderBatch),
+    ('/tasks/flush_game', FlushGame),
+    ('/tasks/update_game_stats', UpdateGameStats),
+    ('/tasks/match_players', MatchPlayers),
+    ('/tasks/tournament_result', TournamentResult),
+    ('/tasks/tournament_round', AdvanceTournament),
+    ('/tasks/replay_scan', ScanReplayGames),
+    ('/tasks/replay_batch', ReplayBatch),
+    ('/tasks/backfill', BackfillPage),
+    ('/admin/backfill', Backfill),
+    ('/admin/replay', ReplayGames),
+    ('/admin/instrumentation', InstrumentationStats)
 ], debug=True)
@@ -0,0 +1,200 @@
+"""matchmaking.py - Queue pairing waiting players into games.
+
+join() adds a player's QueueEntry with a rating bucket taken from their
+UserStats and makes sure a pairing task is scheduled for the current
+window.  A join is one entity write and a named task add, however long the
+queue is.  The pairing task, which runs on its own queue one at a time,
+reads the waiting entries in (variant, rating, joined) order so neighbours
+have the closest ratings and pairs them.  Each run reads at most
+MATCH_PAGES_PER_RUN pages, resuming from the cursor the previous run
+checkpointed and queueing the next run until the scan reaches the end of
+the queue, so a long queue is scanned once rather than on every run.  Each
+pair's game is created in a transaction with both entries, under an id
+derived from them, so a retried pairing never creates a second game.  A
+pair's allowed rating gap widens the longer they wait.  Matches are
+published to memcache, where poll() looks for them."""
+
+import time
+from datetime import datetime
+
+from google.appengine.api import memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import engine
+import gamestats
+from models import Game, JobCheckpoint, QueueEntry, UserStats
+
+MATCH_QUEUE = 'matchmaking'
+MATCH_WINDOW = 2
+MATCH_BATCH_SIZE = 500
+MATCH_PAGES_PER_RUN = 4
+MATCH_JOB = 'matchmaking'
+RATING_BUCKETS = 10
+# Seconds of waiting after which a pair may be one more bucket apart.
+RATING_RELAX_SECONDS = 30
+MEMCACHE_MATCH = 'MATCH:'
+MATCH_TTL = 3600
+POLL_INTERVAL = 0.5
+
+
+def rating(stats):
+    """Returns the rating bucket of a player's UserStats. Players without
+    finished games start in the middle."""
+    if stats is None or not stats.games:
+        return RATING_BUCKETS // 2
+    return min(int(stats.win_percent * RATING_BUCKETS), RATING_BUCKETS - 1)
+
+
+def variant_name(geometry):
+    return '{0}x{1}x{2}'.format(geometry.width, geometry.height,
+                                geometry.win_length)
+
+
+def join(user, geometry=engine.CLASSIC):
+    """Puts the user in the queue for a game of the variant and returns
+    their QueueEntry. A user already waiting keeps their place (and
+    variant)."""
+    stats = UserStats.key_for(user.key).get()
+    entry, joined = _enter(user.key, geometry, rating(stats))
+    if joined:
+        memcache.delete(MEMCACHE_MATCH + str(user.key.id()))
+        _schedule()
+    return entry
+
+
+@ndb.transactional
+def _enter(user_key, geometry, bucket):
+    """Returns (entry, joined), only writing a new entry if the user isn't
+    already waiting, so two joins or a join and a pairing can't both write
+    the entry"""
+    entry = QueueEntry.get_by_id(user_key.id())
+    if entry and entry.waiting:
+        return entry, False
+    entry = QueueEntry(id=user_key.id(), user=user_key,
+                       variant=variant_name(geometry),
+                       width=geometry.width, height=geometry.height,
+                       win_length=geometry.win_length, rating=bucket,
+                       joined=datetime.now())
+    entry.put()
+    return entry, True
+
+
+def _schedule():
+    window = int(time.time()) // MATCH_WINDOW
+    try:
+        taskqueue.add(url='/tasks/match_players', queue_name=MATCH_QUEUE,
+                      name='match-players-{0}'.format(window),
+                      countdown=MATCH_WINDOW)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def poll(user_key, wait=0):
+    """Returns the key of the game the user was matched into, waiting up to
+    wait seconds for it, or None if the user is still waiting. Raises
+    KeyError if the user is not in the queue."""
+    cache_key = MEMCACHE_MATCH + str(user_key.id())
+    deadline = time.time() + wait
+    while True:
+        urlsafe = memcache.get(cache_key)
+        if urlsafe:
+            return ndb.Key(urlsafe=urlsafe)
+        if time.time() + POLL_INTERVAL > deadline:
+            break
+        time.sleep(POLL_INTERVAL)
+    # The match may have been evicted from memcache.
+    entry = QueueEntry.get_by_id(user_key.id())
+    if entry is None:
+        raise KeyError(user_key)
+    return None if entry.waiting else entry.game
+
+
+def pair_waiting():
+    """Pairs the waiting players of up to MATCH_PAGES_PER_RUN pages and
+    returns the number of games created. The query only finds candidates:
+    each page is read again by key and entries no longer waiting (the index
+    can lag behind an earlier pairing) are dropped."""
+    now = datetime.now()
+    checkpoint = JobCheckpoint.get_or_insert(MATCH_JOB)
+    cursor = Cursor(urlsafe=checkpoint.cursor) if checkpoint.cursor else None
+    query = QueueEntry.query(QueueEntry.waiting == True).order(
+        QueueEntry.variant, QueueEntry.rating, QueueEntry.joined)
+    more, unpaired, created = True, [], 0
+    for _ in range(MATCH_PAGES_PER_RUN):
+        keys, cursor, more = query.fetch_page(
+            MATCH_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+        page = [entry for entry in ndb.get_multi(keys)
+                if entry and entry.waiting]
+        pairs, unpaired = _pair(unpaired + page, now)
+        created += _create_games(pairs)
+        if not more:
+            break
+    # An entry left unpaired at the end of the run waits for the next scan.
+    checkpoint.cursor = cursor.urlsafe() if more and cursor else None
+    checkpoint.put()
+    if checkpoint.cursor:
+        taskqueue.add(url='/tasks/match_players', queue_name=MATCH_QUEUE)
+    return created
+
+
+def _pair(entries, now):
+    """Pairs neighbouring entries and returns the pairs and the unpaired
+    entry at the end, which may pair with the start of the next page"""
+    pairs, index = [], 0
+    while index + 1 < len(entries):
+        first, second = entries[index], entries[index + 1]
+        waited = (now - min(first.joined, second.joined)).total_seconds()
+        if (first.variant == second.variant and
+                abs(first.rating - second.rating) <=
+                1 + int(waited // RATING_RELAX_SECONDS)):
+            pairs.append((first, second))
+            index += 2
+        else:
+            index += 1
+    return pairs, entries[index:]
+
+
+def _game_key(first, second):
+    """Returns the key of the game between two entries, the same however
+    often they are paired"""
+    return ndb.Key(Game, 'q{0}-{1}-{2}-{3}'.format(
+        first.key.id(), first.joined.strftime('%Y%m%d%H%M%S%f'),
+        second.key.id(), second.joined.strftime('%Y%m%d%H%M%S%f')))
+
+
+@ndb.transactional_tasklet(xg=True)
+def _create_game_async(first, second):
+    """Tasklet creating the game of a pair and marking both entries as
+    matched, unless either has been paired or has left and joined again
+    since it was read. Returns the entries, or None."""
+    entries = yield ndb.get_multi_async([first.key, second.key])
+    for entry, read in zip(entries, (first, second)):
+        if entry is None or not entry.waiting or entry.joined != read.joined:
+            raise ndb.Return(None)
+    geometry = engine.get_geometry(first.width, first.height,
+                                   first.win_length)
+    game = Game.build(first.user, second.user, geometry=geometry)
+    game.key = _game_key(first, second)
+    for entry in entries:
+        entry.waiting = False
+        entry.game = game.key
+    yield ndb.put_multi_async([game] + entries)
+    raise ndb.Return(entries)
+
+
+def _create_games(pairs):
+    # The player who waited longer moves first.
+    pairs = [(first, second) if first.joined <= second.joined else
+             (second, first) for first, second in pairs]
+    matched = [future.get_result() for future in
+               [_create_game_async(first, second) for first, second in pairs]]
+    entries = [entry for pair in matched if pair for entry in pair]
+    if not entries:
+        return 0
+    memcache.set_multi(dict((str(entry.key.id()), entry.game.urlsafe())
+                            for entry in entries),
+                       key_prefix=MEMCACHE_MATCH, time=MATCH_TTL)
+    games = len(entries) // 2
+    gamestats.record(games_created=games)
+    return games
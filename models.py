@@ -2,12 +2,16 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
-import logging
 import random
 from datetime import date
 from protorpc import messages
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
+import engine
+from instrument import timed_call
+from utils import EntityMap
+
 
 class User(ndb.Model):
 
@@ -16,15 +20,237 @@ class User(ndb.Model):
     email = ndb.StringProperty()
 
 
+class UserName(ndb.Model):
+
+    """Reservation of a user name, keyed by the normalized name (see
+    usernames.normalize) and pointing at the User that holds it"""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+
+
+class UserStats(ndb.Model):
+
+    """Materialized win/loss record of a User, keyed by the User's id and
+    kept up to date by Game.record_score so rankings never scan Scores"""
+    user = ndb.KeyProperty(required=True, kind='User')
+    user_name = ndb.StringProperty(required=True, indexed=False)
+    wins = ndb.IntegerProperty(required=True, default=0)
+    losses = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    ties = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    points = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    win_percent = ndb.FloatProperty(required=True, default=0.0)
+
+    @classmethod
+    def key_for(cls, user_key):
+        return ndb.Key(cls, user_key.id())
+
+    @classmethod
+    def for_user(cls, user):
+        """Returns an empty stats entity for a new User"""
+        return cls(key=cls.key_for(user.key), user=user.key,
+                   user_name=user.name)
+
+    @classmethod
+    def record_result(cls, winner, loser, won, points, computer=None):
+        """Adds the outcome of one finished game to both players' stats,
+        except those of computer, the computer player's key in a game
+        against it. Missing stats entities (users created before stats
+        existed) are created on the fly."""
+        players = [user_key for user_key in (winner, loser)
+                   if user_key != computer]
+        stats = ndb.get_multi([cls.key_for(user_key) for user_key in players])
+        missing = [user_key for user_key, stat in zip(players, stats)
+                   if stat is None]
+        users = dict(zip(missing, ndb.get_multi(missing)))
+        stats = [stat or cls.for_user(users[user_key])
+                 for user_key, stat in zip(players, stats)]
+        for user_key, stat in zip(players, stats):
+            if not won:
+                stat.ties += 1
+            elif user_key == winner:
+                stat.wins += 1
+                stat.points += points
+            else:
+                stat.losses += 1
+        for stat in stats:
+            stat.win_percent = stat.wins / float(stat.games)
+        ndb.put_multi(stats)
+
+    @property
+    def games(self):
+        return self.wins + self.losses + self.ties
+
+    @timed_call('serialize')
+    def to_form(self):
+        return UserRank(user_name=self.user_name, wins=self.wins,
+                        win_percent=self.win_percent, losses=self.losses,
+                        ties=self.ties, points=self.points)
+
+
+class GameStatsShard(ndb.Model):
+
+    """One shard of the global game counters. Updates go to a random shard
+    so game creation and endings don't contend on one entity; see
+    gamestats"""
+    games_created = ndb.IntegerProperty(default=0, indexed=False)
+    games_finished = ndb.IntegerProperty(default=0, indexed=False)
+    games_won = ndb.IntegerProperty(default=0, indexed=False)
+    games_cancelled = ndb.IntegerProperty(default=0, indexed=False)
+    total_moves = ndb.IntegerProperty(default=0, indexed=False)
+    total_points = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class JobCheckpoint(ndb.Model):
+
+    """Progress of a batched background job, keyed by job name. A run that
+    dies part way resumes from the stored cursor instead of starting over"""
+    run = ndb.IntegerProperty(required=True, default=0)
+    page = ndb.IntegerProperty(required=True, default=0)
+    cursor = ndb.StringProperty(indexed=False)
+    done = ndb.BooleanProperty(required=True, default=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class QueueEntry(ndb.Model):
+
+    """A player in the matchmaking queue, keyed by the User's id. Once
+    paired the entry keeps the game until the player joins again; see
+    matchmaking"""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    # The variant as 'WxHxN', for grouping, and its parts.
+    variant = ndb.StringProperty(required=True)
+    width = ndb.IntegerProperty(required=True, indexed=False)
+    height = ndb.IntegerProperty(required=True, indexed=False)
+    win_length = ndb.IntegerProperty(required=True, indexed=False)
+    rating = ndb.IntegerProperty(required=True)
+    joined = ndb.DateTimeProperty(required=True)
+    waiting = ndb.BooleanProperty(required=True, default=True)
+    game = ndb.KeyProperty(kind='Game', indexed=False)
+
+
+class Tournament(ndb.Model):
+
+    """A round robin or single elimination tournament; see tournaments.
+    players is in seed order"""
+    name = ndb.StringProperty(required=True, indexed=False)
+    kind = ndb.StringProperty(required=True, indexed=False,
+                              choices=('round_robin', 'elimination'))
+    players = ndb.KeyProperty(repeated=True, kind='User', indexed=False)
+    width = ndb.IntegerProperty(required=True, indexed=False)
+    height = ndb.IntegerProperty(required=True, indexed=False)
+    win_length = ndb.IntegerProperty(required=True, indexed=False)
+    round = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    rounds = ndb.IntegerProperty(required=True, indexed=False)
+    finished = ndb.BooleanProperty(required=True, default=False,
+                                   indexed=False)
+    champion = ndb.KeyProperty(kind='User', indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+    def to_form(self, entities=None):
+        if entities is None:
+            entities = EntityMap()
+            entities.prefetch([self.champion])
+        return TournamentForm(
+            urlsafe_key=self.key.urlsafe(), name=self.name, kind=self.kind,
+            players=len(self.players), round=self.round, rounds=self.rounds,
+            finished=self.finished, width=self.width, height=self.height,
+            win_length=self.win_length,
+            champion_name=entities.get(self.champion).name
+            if self.champion else None)
+
+
+class TournamentRound(ndb.Model):
+
+    """One tournament round, keyed by tournament id and round. complete is
+    set once, by the result that finds every game of the round recorded"""
+    games = ndb.IntegerProperty(required=True, indexed=False)
+    # Elimination players without an opponent, advancing directly.
+    byes = ndb.KeyProperty(repeated=True, kind='User', indexed=False)
+    complete = ndb.BooleanProperty(required=True, default=False,
+                                   indexed=False)
+
+    @classmethod
+    def key_for(cls, tournament_key, round):
+        return ndb.Key(cls, '{0}-{1}'.format(tournament_key.id(), round))
+
+
+class TournamentResult(ndb.Model):
+
+    """Result of one tournament game, keyed by tournament id, round and
+    slot, so the games of a round never write the same entity and a
+    replayed result is never counted twice. advancing is the winner, or
+    the better seed after a tie"""
+    advancing = ndb.KeyProperty(required=True, kind='User', indexed=False)
+
+    @classmethod
+    def key_for(cls, tournament_key, round, slot):
+        return ndb.Key(cls, '{0}-{1}-{2}'.format(tournament_key.id(), round,
+                                                 slot))
+
+
+class TournamentRoundShard(ndb.Model):
+
+    """One shard of the count of a round's recorded results, keyed by
+    tournament id, round and shard; see tournaments"""
+    results = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+class TournamentStanding(ndb.Model):
+
+    """A player's record in a tournament, keyed by tournament and user id
+    and updated as each of their games ends, so standings are one indexed
+    query however many players there are"""
+    tournament = ndb.KeyProperty(required=True, kind='Tournament')
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    user_name = ndb.StringProperty(required=True, indexed=False)
+    # 2 per win and 1 per tie; ties are broken by game points.
+    match_points = ndb.IntegerProperty(required=True, default=0)
+    points = ndb.IntegerProperty(required=True, default=0)
+    wins = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    losses = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    ties = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+    @classmethod
+    def key_for(cls, tournament_key, user_key):
+        return ndb.Key(cls, '{0}-{1}'.format(tournament_key.id(),
+                                             user_key.id()))
+
+    def to_form(self):
+        return StandingForm(user_name=self.user_name,
+                            match_points=self.match_points,
+                            points=self.points, wins=self.wins,
+                            losses=self.losses, ties=self.ties)
+
+
+class ReplayIssue(ndb.Model):
+
+    """A game that failed validation in a replay run (see replay), keyed
+    by run and game id so a retried batch overwrites its own issues"""
+    run = ndb.IntegerProperty(required=True)
+    game = ndb.KeyProperty(required=True, kind='Game')
+    problems = ndb.StringProperty(repeated=True, indexed=False)
+    fixed = ndb.BooleanProperty(required=True, default=False)
+
+    @classmethod
+    def id_for(cls, run, game_key):
+        return '{0}-{1}'.format(run, game_key.id())
+
+
 class Column(ndb.Model):
+
+    """Legacy grid column, only read to convert games created before the
+    bitboard engine"""
     row = ndb.IntegerProperty(repeated=True)
 
 
 class HistoricalRecord(ndb.Model):
+
+    """Legacy move record, only read to convert games created before moves
+    were packed into Game.moves"""
     player_name = ndb.StringProperty(required=True)
     column = ndb.IntegerProperty(required=True)
     game_state = ndb.StringProperty(required=True)
 
+    @timed_call('serialize')
     def to_form(self):
         form = HistoryForm()
         form.player_name = self.player_name
@@ -33,147 +259,339 @@ class HistoricalRecord(ndb.Model):
         return form
 
 
+RECENT_REQUESTS = 10
+# Bitboards above this are stored as hex strings; see BitboardProperty.
+MAX_INT64 = (1 << 63) - 1
+# Characters for the columns in packed move strings.
+MOVE_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def pack_moves(moves):
+    """Returns Game.moves as text, one MOVE_DIGITS character per move"""
+    return ''.join(MOVE_DIGITS[ord(move)] for move in moves)
+
+
+def unpack_moves(text):
+    """Inverse of pack_moves. Raises ValueError on a character that is not a
+    column"""
+    return ''.join(chr(MOVE_DIGITS.index(digit)) for digit in text.lower())
+
+
+class BitboardProperty(ndb.GenericProperty):
+
+    """Engine bitboard of any size. Stored as an integer while it fits in
+    64 bits, as every classic size board does, and as a hex string beyond
+    that"""
+    def _validate(self, value):
+        if not isinstance(value, (int, long)) or value < 0:
+            raise datastore_errors.BadValueError(
+                'Expected a bitboard, got %r' % (value,))
+
+    def _to_base_type(self, value):
+        if value > MAX_INT64:
+            return '%x' % value
+
+    def _from_base_type(self, value):
+        if isinstance(value, basestring):
+            return int(value, 16)
+
+
 class Game(ndb.Model):
 
     """Game object"""
+    # Each player's chips as an engine bitboard.
+    board1 = BitboardProperty(required=True, default=0, indexed=False)
+    board2 = BitboardProperty(required=True, default=0, indexed=False)
+    # The variant played; games from before variants are classic.
+    width = ndb.IntegerProperty(default=engine.WIDTH, indexed=False)
+    height = ndb.IntegerProperty(default=engine.HEIGHT, indexed=False)
+    win_length = ndb.IntegerProperty(default=engine.WIN_LENGTH,
+                                     indexed=False)
+    # Columns played so far, one byte per move; user1 plays the even moves.
+    moves = ndb.BlobProperty(required=True, default='')
+    # Legacy grid and history, replaced by board1/board2 and moves the first
+    # time the game is used.
     gamegrid = ndb.LocalStructuredProperty(Column, repeated=True)
     game_score = ndb.IntegerProperty(required=True, default=0)
     game_winner = ndb.KeyProperty(kind='User')
-    game_over = ndb.BooleanProperty(required=True, default=False)
+    # Queries use open instead.
+    game_over = ndb.BooleanProperty(required=True, default=False,
+                                    indexed=False)
     user1 = ndb.KeyProperty(required=True, kind='User')
     user2 = ndb.KeyProperty(required=True, kind='User')
+    # Denormalized for "open games of a user" lookups: both players and
+    # whether the game is still being played.
+    players = ndb.KeyProperty(repeated=True, kind='User')
+    open = ndb.BooleanProperty(required=True, default=True)
     player_1_turn = ndb.BooleanProperty(required=True, default=True)
+    # user2 is the computer, which replies to each of user1's moves.
+    vs_computer = ndb.BooleanProperty(required=True, default=False,
+                                      indexed=False)
+    # Bumped by every move; a save never replaces a newer stored version.
+    version = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    # Idempotency keys of the latest moves, so client retries are no-ops.
+    recent_requests = ndb.StringProperty(repeated=True, indexed=False)
     game_history = ndb.LocalStructuredProperty(HistoricalRecord, repeated=True)
+    # Last save, for archiving finished games and expiring abandoned ones.
+    updated = ndb.DateTimeProperty(auto_now=True)
+    # Set on tournament games: the round and the game's slot in it.
+    tournament = ndb.KeyProperty(kind='Tournament', indexed=False)
+    tournament_round = ndb.IntegerProperty(indexed=False)
+    tournament_slot = ndb.IntegerProperty(indexed=False)
 
     @classmethod
-    def new_game(cls, user1, user2):
+    def new_game(cls, user1, user2, vs_computer=False,
+                 geometry=engine.CLASSIC):
         """Creates and returns a new game"""
-        emptyColumn = Column(row=[0, 0, 0, 0, 0, 0, 0])
-        grid = [emptyColumn,
-                emptyColumn,
-                emptyColumn,
-                emptyColumn,
-                emptyColumn,
-                emptyColumn,
-                emptyColumn]
+        game = cls.build(user1, user2, vs_computer, geometry)
+        game.put()
+        return game
+
+    @classmethod
+    def build(cls, user1, user2, vs_computer=False,
+              geometry=engine.CLASSIC):
+        """Returns a new game without saving it, for batched writes"""
         if user1 == user2:
             raise ValueError;
-        game = Game(user1=user1,
+        return Game(user1=user1,
                     user2=user2,
-                    gamegrid=grid,
+                    players=[user1, user2],
+                    open=True,
+                    vs_computer=vs_computer,
+                    width=geometry.width,
+                    height=geometry.height,
+                    win_length=geometry.win_length,
                     game_over=False)
-        game.put()
-        return game
 
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    def geometry(self):
+        """Returns the engine Geometry of this game's variant"""
+        return engine.get_geometry(self.width, self.height, self.win_length)
+
+    def user_keys(self):
+        """Returns the User keys needed to build this game's form"""
+        return [self.user1, self.user2, self.game_winner]
+
+    @timed_call('serialize')
+    def to_form(self, message, entities=None):
+        """Returns a GameForm representation of the Game. Users are looked up
+        through the request's EntityMap when one is given"""
+        if entities is None:
+            entities = EntityMap()
+            entities.prefetch(self.user_keys())
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.user1_name = self.user1.get().name
-        form.user2_name = self.user2.get().name
+        form.user1_name = entities.get(self.user1).name
+        form.user2_name = entities.get(self.user2).name
         form.game_over = self.game_over
         form.message = message
-        index = 0
-        columnString = "grid_column"
-        for aColumn in self.gamegrid:
-            currentColumn = columnString + str(index)
-            columnField = form.field_by_name(currentColumn)
-            listcolumn = []
-            for row in aColumn.row:
-                listcolumn.append(row)
-            setattr(form, columnField.name, listcolumn)
-            # logging.warning(listcolumn)
-            index += 1
+        board = self.get_board()
+        form.width, form.height, form.win_length = \
+            self.width, self.height, self.win_length
+        form.board = board.packed()
+        if self.width == engine.WIDTH:
+            (form.grid_column0, form.grid_column1, form.grid_column2,
+             form.grid_column3, form.grid_column4, form.grid_column5,
+             form.grid_column6) = board.columns()
         if self.game_winner != None:
-            form.game_winner = self.game_winner.get().name
+            form.game_winner = entities.get(self.game_winner).name
+        form.etag = self.etag()
         return form
 
-    def end_game(self, winner=None, won=False):
-        """Ends the game - if won is True, the player won. - if won is False,
-        the player lost."""
+    def etag(self):
+        """Tag of the game's state, which changes with every move"""
+        self.upgrade()
+        return '{0}-{1}'.format(self.version, len(self.moves))
+
+    @timed_call('serialize')
+    def to_compact_form(self, message, since_move=None):
+        """Returns a GameForm with the board as the two bitboards and the
+        players as keys, so no User is loaded. With since_move, only the
+        moves from that move number on are sent, packed one character per
+        column, instead of the board."""
+        self.upgrade()
+        form = GameForm(urlsafe_key=self.key.urlsafe(),
+                        game_over=self.game_over,
+                        message=message,
+                        etag=self.etag(),
+                        move_count=len(self.moves),
+                        user1_key=self.user1.urlsafe(),
+                        user2_key=self.user2.urlsafe(),
+                        width=self.width, height=self.height,
+                        win_length=self.win_length)
+        if self.game_winner != None:
+            form.game_winner_key = self.game_winner.urlsafe()
+        if since_move is None:
+            if max(self.board1, self.board2) > MAX_INT64:
+                # Too big for the message's integers.
+                form.board = self.get_board().packed()
+            else:
+                form.board1, form.board2 = self.board1, self.board2
+        else:
+            form.first_move = since_move
+            form.moves = pack_moves(self.moves[since_move:])
+        return form
+
+    def not_modified_form(self):
+        """Returns the GameForm sent when the client's etag is current"""
+        return GameForm(urlsafe_key=self.key.urlsafe(),
+                        game_over=self.game_over, message='Not modified',
+                        etag=self.etag(), not_modified=True)
+
+    def upgrade(self):
+        """Converts a game stored with the legacy grid or history, or without
+        players and open, in place"""
+        if not self.players:
+            self.players = [self.user1, self.user2]
+            # Unset, open reads as its default True even for ended games.
+            self.open = not self.game_over
+        if self.gamegrid:
+            self.set_board(engine.Board.from_columns(
+                [aColumn.row for aColumn in self.gamegrid],
+                self.geometry()))
+            self.gamegrid = []
+        if self.game_history:
+            self.moves = ''.join(chr(history.column)
+                                 for history in self.game_history)
+            self.game_history = []
+
+    def get_board(self):
+        """Returns the engine Board holding the chips of this game"""
+        self.upgrade()
+        return engine.Board(self.board1, self.board2, self.geometry())
+
+    def set_board(self, board):
+        self.board1, self.board2 = board.bitboards
+
+    def drop_chip(self, column):
+        """Drops the current player's chip into the column. Raises ValueError
+        if the column is not on the board or is full."""
+        board = self.get_board()
+        board.drop(column, 1 if self.player_1_turn else 2)
+        self.set_board(board)
+        return board
+
+    def finish(self, winner=None):
+        """Marks the game as over without writing anything. The caller saves
+        the game and calls record_score in one transaction, as
+        gamecache.save does"""
         self.game_over = True
+        self.open = False
         self.game_winner = winner
+
+    def record_score(self, won=None):
+        """Adds the finished game to the score 'board' and the players'
+        stats. won defaults to whether the game has a winner. Call it in the
+        transaction that saves the ended game; the Score shares the game's
+        id so it can never be recorded twice."""
+        winner = self.game_winner
+        if won is None:
+            won = winner is not None
         loser = self.user1
         if loser == winner:
             loser = self.user2
-        self.put()
-        # Add the game to the score 'board'
+        if winner is None:
+            # A tie still records both players, won=False marks the
+            # winner/loser distinction as meaningless.
+            winner = self.user2
         points = self.spaces_left()
-        score = Score(winner=winner, loser=loser, date=date.today(), won=won,
+        score = Score(id=self.key.id(), winner=winner, loser=loser,
+                      players=[winner, loser], date=date.today(), won=won,
                       points=points)
-        score.put()
-
-    def has_last_chip_won(self, column, endpoints):
-        lastUsedIndex = 0
-        chipval = 0
-        # get the last chip put in the column
-        for idx, chipval in enumerate(self.gamegrid[column].row):
-
-            if chipval == 0:
-                if idx == 0:
-                    raise endpoints.NotFoundException(
-                        'no chip in this column, could not have been winner 1')
-                lastUsedIndex = idx - 1
-                break
-            if idx == 6:
-                lastUsedIndex = 6
-
-        chipval = self.gamegrid[column].row[lastUsedIndex]
-        # if the last chip isn't the current players turn, we have a problem.
-        if self.player_1_turn and chipval != 1:
-            raise endpoints.NotFoundException(
-                'Wrong chip on this column, could not have been winner 2')
-        elif not self.player_1_turn and chipval != 2:
-            raise endpoints.NotFoundException(
-                'Wrong chip on this column, could not have been winner 3')
-
-        # Check for 3 more in the -45 degree direction
-        if self.check_win_direction(column, lastUsedIndex, -1, 1, 3, chipval):
-            return True
-
-        # Check for 3 more in the horizontal
-        if self.check_win_direction(column, lastUsedIndex, -1, 0, 3, chipval):
-            return True
-
-        # Check for 3 more to the 45 degree direction
-        if self.check_win_direction(column, lastUsedIndex, -1, -1, 3, chipval):
-            return True
-
-        # Check for 3 more vertically
-        if self.check_win_direction(column, lastUsedIndex, 0, -1, 3, chipval):
-            return True
-
-    def check_win_direction(self, x, y, dx, dy, number_left, player,
-                            alreadyreversed=False):
-        logging.info(str(x)+ '_'+str(dx) +',' + str(y)+'_'+str(dy)+', '+
-            str(number_left)+ '_'+str(player) + 'A? '+ str(alreadyreversed))
-        
-        end_of_grid = (x+dx < 0 or x + dx > 6 or y+dy < 0 or y + dy > 6)
-        if not end_of_grid and self.gamegrid[x + dx].row[y+dy] == player:
-            if number_left == 1:
-                return True
+        score_saved = score.put_async()
+        UserStats.record_result(winner, loser, won, points,
+                                self.user2 if self.vs_computer else None)
+        score_saved.get_result()
+
+    def record_move(self, column, request_id=None):
+        self.upgrade()
+        self.moves += chr(column)
+        self.version += 1
+        if request_id:
+            self.recent_requests = (self.recent_requests +
+                                    [request_id])[-RECENT_REQUESTS:]
+
+    @property
+    def move_count(self):
+        self.upgrade()
+        return len(self.moves)
+
+    @timed_call('serialize')
+    def history_forms(self, from_move=0, limit=None, entities=None):
+        """Returns HistoryForms for the moves starting at from_move, at most
+        limit of them. Only those moves are unpacked."""
+        self.upgrade()
+        if entities is None:
+            entities = EntityMap()
+            entities.prefetch(self.user_keys())
+        end = len(self.moves) if limit is None else from_move + limit
+        forms = []
+        for move in range(from_move, min(end, len(self.moves))):
+            if move == len(self.moves) - 1 and self.game_over:
+                state = 'Just Won!' if self.game_winner else 'Tie Game'
             else:
-                number_left -= 1
-                return self.check_win_direction(
-                    x+dx, y+dy, dx, dy, number_left, player, alreadyreversed)
-        elif alreadyreversed == False:
-            alreadyreversed = True
-            number_gone = 3-number_left
-            return self.check_win_direction(x-(dx*number_gone),
-                                            y-(dy*number_gone), -dx, 
-                                            -dy, number_left, player,
-                                            alreadyreversed)
-        else:
-            return False
+                state = "Next player's turn"
+            player = self.user1 if move % 2 == 0 else self.user2
+            forms.append(HistoryForm(player_name=entities.get(player).name,
+                                     column=ord(self.moves[move]),
+                                     game_state=state, move=move))
+        return HistoryForms(items=forms)
+
+    def has_last_chip_won(self):
+        """Returns True if the player whose turn it is has four in a row.
+        Only the last chip placed can complete a line, so this is called
+        right after that player's drop."""
+        return self.get_board().has_won(1 if self.player_1_turn else 2)
 
     def spaces_left(self):
         # score is the total number of chips not used in the game.
-        score = 0
-        for aColumn in self.gamegrid:
-            for item in aColumn.row:
-                if item == 0:
-                    score += 1
-        return score
+        return self.get_board().spaces_left()
+
+
+class ArchivedGame(ndb.Model):
+
+    """Compact copy of a finished or expired Game, which it replaces once
+    old enough (see archive). It has the id of the Game, and so of its
+    Score, and keeps only the players, the variant, the packed moves and
+    the outcome; the board is rebuilt from the moves when read."""
+    user1 = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    user2 = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    vs_computer = ndb.BooleanProperty(default=False, indexed=False)
+    width = ndb.IntegerProperty(required=True, indexed=False)
+    height = ndb.IntegerProperty(required=True, indexed=False)
+    win_length = ndb.IntegerProperty(required=True, indexed=False)
+    moves = ndb.BlobProperty(required=True, default='')
+    game_winner = ndb.KeyProperty(kind='User', indexed=False)
+    # Expired games were abandoned while still open and have no Score.
+    expired = ndb.BooleanProperty(default=False, indexed=False)
+    player_1_turn = ndb.BooleanProperty(default=True, indexed=False)
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def from_game(cls, game, expired=False):
+        game.upgrade()
+        return cls(id=game.key.id(), user1=game.user1, user2=game.user2,
+                   vs_computer=game.vs_computer, width=game.width,
+                   height=game.height, win_length=game.win_length,
+                   moves=game.moves, game_winner=game.game_winner,
+                   expired=expired, player_1_turn=game.player_1_turn,
+                   version=game.version, finished=game.updated)
+
+    def to_game(self):
+        """Returns the archived game as a finished Game, which is never
+        saved"""
+        game = Game(key=ndb.Key(Game, self.key.id()), user1=self.user1,
+                    user2=self.user2, players=[self.user1, self.user2],
+                    vs_computer=self.vs_computer, width=self.width,
+                    height=self.height, win_length=self.win_length,
+                    moves=self.moves, game_winner=self.game_winner,
+                    game_over=True, open=False,
+                    player_1_turn=self.player_1_turn, version=self.version)
+        board = engine.Board(geometry=game.geometry())
+        for number, move in enumerate(self.moves):
+            board.drop(ord(move), 1 if number % 2 == 0 else 2)
+        game.set_board(board)
+        return game
 
 
 class Score(ndb.Model):
@@ -181,14 +599,25 @@ class Score(ndb.Model):
     """Score object"""
     winner = ndb.KeyProperty(required=True, kind='User')
     loser = ndb.KeyProperty(required=True, kind='User')
+    # Both players, so one equality filter finds a user's scores.
+    players = ndb.KeyProperty(repeated=True, kind='User')
     date = ndb.DateProperty(required=True)
     won = ndb.BooleanProperty(required=True)
     points = ndb.IntegerProperty(required=True)
 
-    def to_form(self):
-        return ScoreForm(winner_name=self.winner.get().name,
-                         loser_name=self.loser.get().name, won=self.won,
-                         date=str(self.date), points=self.points)
+    def user_keys(self):
+        """Returns the User keys needed to build this score's form"""
+        return [self.winner, self.loser]
+
+    @timed_call('serialize')
+    def to_form(self, entities=None):
+        if entities is None:
+            entities = EntityMap()
+            entities.prefetch(self.user_keys())
+        return ScoreForm(winner_name=entities.get(self.winner).name,
+                         loser_name=entities.get(self.loser).name,
+                         won=self.won, date=str(self.date),
+                         points=self.points)
 
 
 class GameForm(messages.Message):
@@ -197,7 +626,7 @@ class GameForm(messages.Message):
     urlsafe_key = messages.StringField(1, required=True)
     game_over = messages.BooleanField(3, required=True)
     message = messages.StringField(4, required=True)
-    user1_name = messages.StringField(5, required=True)
+    user1_name = messages.StringField(5)
     grid_column0 = messages.IntegerField(6, repeated=True)
     grid_column1 = messages.IntegerField(7, repeated=True)
     grid_column2 = messages.IntegerField(8, repeated=True)
@@ -205,8 +634,28 @@ class GameForm(messages.Message):
     grid_column4 = messages.IntegerField(10, repeated=True)
     grid_column5 = messages.IntegerField(11, repeated=True)
     grid_column6 = messages.IntegerField(12, repeated=True)
-    user2_name = messages.StringField(13, required=True)
+    user2_name = messages.StringField(13)
     game_winner = messages.StringField(14, required=False)
+    etag = messages.StringField(15)
+    # Set instead of the state when the client's etag is still current.
+    not_modified = messages.BooleanField(16)
+    # Compact mode: bitboards, move count and player keys.
+    board1 = messages.IntegerField(17)
+    board2 = messages.IntegerField(18)
+    move_count = messages.IntegerField(19)
+    user1_key = messages.StringField(20)
+    user2_key = messages.StringField(21)
+    game_winner_key = messages.StringField(22)
+    # With since_move: the moves from first_move on, one character each.
+    first_move = messages.IntegerField(23)
+    moves = messages.StringField(24)
+    # The variant, and the board as one '0', '1' or '2' per cell, column by
+    # column from the bottom up. grid_column0-6 are only set on 7 column
+    # boards.
+    width = messages.IntegerField(25)
+    height = messages.IntegerField(26)
+    win_length = messages.IntegerField(27)
+    board = messages.StringField(28)
 
 
 class GameForms(messages.Message):
@@ -215,18 +664,59 @@ class GameForms(messages.Message):
     items = messages.MessageField(GameForm, 1, repeated=True)
 
 
+class GameResultForm(messages.Message):
+
+    """Outcome of one operation of a batch, either a game or an error"""
+    game = messages.MessageField(GameForm, 1)
+    error = messages.StringField(2)
+
+
+class GameResultForms(messages.Message):
+
+    """Return the outcome of each operation of a batch, in request order"""
+    items = messages.MessageField(GameResultForm, 1, repeated=True)
+
+
 class NewGameForm(messages.Message):
 
-    """Used to create a new game"""
+    """Used to create a new game. With vs_computer set, user_2 is left out
+    and user_1 plays the computer"""
     user_1 = messages.StringField(1, required=True)
-    user_2 = messages.StringField(2, required=True)
+    user_2 = messages.StringField(2)
+    vs_computer = messages.BooleanField(3, default=False)
+    width = messages.IntegerField(4, default=engine.WIDTH)
+    height = messages.IntegerField(5, default=engine.HEIGHT)
+    win_length = messages.IntegerField(6, default=engine.WIN_LENGTH)
+
+
+class NewGamesForm(messages.Message):
+
+    """Used to create several games at once"""
+    items = messages.MessageField(NewGameForm, 1, repeated=True)
 
 
 class MakeMoveForm(messages.Message):
 
-    """Used to make a move in an existing game"""
+    """Used to make a move in an existing game. request_id is an optional
+    idempotency key: resending a move with the same id doesn't replay it"""
     user = messages.StringField(1, required=True)
     column = messages.IntegerField(2, required=True)
+    request_id = messages.StringField(3)
+
+
+class GameMoveForm(messages.Message):
+
+    """A move in a batch, naming the game it is made in"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    user = messages.StringField(2, required=True)
+    column = messages.IntegerField(3, required=True)
+    request_id = messages.StringField(4)
+
+
+class MakeMovesForm(messages.Message):
+
+    """Used to make several moves at once, applied in order per game"""
+    items = messages.MessageField(GameMoveForm, 1, repeated=True)
 
 
 class ScoreForm(messages.Message):
@@ -243,12 +733,14 @@ class ScoreForms(messages.Message):
 
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class HistoryForm(messages.Message):
     player_name = messages.StringField(1, required=True)
     game_state = messages.StringField(2, required=True)
     column = messages.IntegerField(3, required=True)
+    move = messages.IntegerField(4)
 
 
 class HistoryForms(messages.Message):
@@ -261,10 +753,111 @@ class UserRank(messages.Message):
     user_name = messages.StringField(1, required=True)
     wins = messages.IntegerField(3, required=True)
     win_percent = messages.FloatField(4, required=True)
+    losses = messages.IntegerField(5)
+    ties = messages.IntegerField(6)
+    points = messages.IntegerField(7)
 
 
 class UserRanks(messages.Message):
     items = messages.MessageField(UserRank, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class GameStatsForm(messages.Message):
+
+    """Global game statistics"""
+    games_created = messages.IntegerField(1, required=True)
+    active_games = messages.IntegerField(2, required=True)
+    finished_games = messages.IntegerField(3, required=True)
+    average_moves = messages.FloatField(4, required=True)
+    average_points = messages.FloatField(5, required=True)
+    win_ratio = messages.FloatField(6, required=True)
+    tie_ratio = messages.FloatField(7, required=True)
+
+
+class AiMoveForm(messages.Message):
+
+    """Move suggested by the computer player for whoever's turn it is"""
+    column = messages.IntegerField(1, required=True)
+    score = messages.IntegerField(2, required=True)
+    depth = messages.IntegerField(3, required=True)
+    nodes = messages.IntegerField(4, required=True)
+
+
+class JoinQueueForm(messages.Message):
+
+    """Used to join the matchmaking queue for a variant"""
+    user_name = messages.StringField(1, required=True)
+    width = messages.IntegerField(2, default=engine.WIDTH)
+    height = messages.IntegerField(3, default=engine.HEIGHT)
+    win_length = messages.IntegerField(4, default=engine.WIN_LENGTH)
+
+
+class MatchForm(messages.Message):
+
+    """State of a player in the matchmaking queue: still waiting, or the
+    game they were matched into"""
+    user_name = messages.StringField(1, required=True)
+    waiting = messages.BooleanField(2, required=True)
+    urlsafe_game_key = messages.StringField(3)
+    variant = messages.StringField(4)
+
+
+class PositionForm(messages.Message):
+
+    """Evaluation of a position for the player to move. outcome is set
+    ('win', 'loss' or 'draw') when the position is solved"""
+    column = messages.IntegerField(1, required=True)
+    score = messages.IntegerField(2, required=True)
+    depth = messages.IntegerField(3, required=True)
+    solved = messages.BooleanField(4, required=True)
+    outcome = messages.StringField(5)
+    from_book = messages.BooleanField(6, required=True)
+
+
+class NewTournamentForm(messages.Message):
+
+    """Used to create a tournament. user_names are in seed order"""
+    name = messages.StringField(1, required=True)
+    kind = messages.StringField(2, default='round_robin')
+    user_names = messages.StringField(3, repeated=True)
+    width = messages.IntegerField(4, default=engine.WIDTH)
+    height = messages.IntegerField(5, default=engine.HEIGHT)
+    win_length = messages.IntegerField(6, default=engine.WIN_LENGTH)
+
+
+class TournamentForm(messages.Message):
+
+    """State of a tournament"""
+    urlsafe_key = messages.StringField(1, required=True)
+    name = messages.StringField(2, required=True)
+    kind = messages.StringField(3, required=True)
+    players = messages.IntegerField(4, required=True)
+    round = messages.IntegerField(5, required=True)
+    rounds = messages.IntegerField(6, required=True)
+    finished = messages.BooleanField(7, required=True)
+    champion_name = messages.StringField(8)
+    width = messages.IntegerField(9)
+    height = messages.IntegerField(10)
+    win_length = messages.IntegerField(11)
+
+
+class StandingForm(messages.Message):
+
+    """A player's record in a tournament"""
+    user_name = messages.StringField(1, required=True)
+    match_points = messages.IntegerField(2, required=True)
+    points = messages.IntegerField(3, required=True)
+    wins = messages.IntegerField(4, required=True)
+    losses = messages.IntegerField(5, required=True)
+    ties = messages.IntegerField(6, required=True)
+
+
+class StandingForms(messages.Message):
+
+    """A page of tournament standings, best first"""
+    items = messages.MessageField(StandingForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,162 @@
+"""replay.py - Re-validation of stored games.
+
+Replays the moves of a game through the engine from an empty board and
+compares the outcome with what was stored: the board, whether and how the
+game ended, whose turn it is and the points of its Score.  main.py runs this
+over every game in parallel batches and records a ReplayIssue for each game
+that doesn't match.  Games that ended before Scores shared the game id
+have no Score to check against and are only checked on their own."""
+
+import logging
+
+from google.appengine.ext import ndb
+
+import engine
+import gamecache
+import gamestats
+import tournaments
+from models import Score, ReplayIssue
+
+
+class Outcome(object):
+
+    """Result of replaying a game's moves"""
+    def __init__(self, board, winner, over, player_1_turn, error=None):
+        self.board = board
+        self.winner = winner
+        self.over = over
+        self.player_1_turn = player_1_turn
+        # Why the moves couldn't all be played, if they couldn't.
+        self.error = error
+
+
+def replay(game):
+    """Returns the Outcome of playing the game's moves in order"""
+    game.upgrade()
+    board = engine.Board(geometry=game.geometry())
+    winner = None
+    for number, move in enumerate(game.moves):
+        if winner or not board.spaces_left():
+            return Outcome(board, winner, True, number % 2 == 1,
+                           'moves after the end at move {0}'.format(number))
+        chip = 1 if number % 2 == 0 else 2
+        try:
+            board.drop(ord(move), chip)
+        except ValueError as e:
+            return Outcome(board, winner, False, number % 2 == 0,
+                           'move {0} in column {1}: {2}'.format(
+                               number, ord(move), e))
+        if board.has_won(chip):
+            winner = game.user1 if chip == 1 else game.user2
+    over = winner is not None or not board.spaces_left()
+    # The player who ended the game keeps the turn.
+    player_1_turn = len(game.moves) % 2 == (1 if over else 0)
+    return Outcome(board, winner, over, player_1_turn)
+
+
+def check(game, score):
+    """Returns the problems found with a game and its Score (None if it has
+    none), as a list of strings"""
+    outcome = replay(game)
+    problems = []
+    if outcome.error:
+        problems.append('illegal ' + outcome.error)
+    if outcome.board.bitboards != [game.board1, game.board2]:
+        problems.append('board does not match the moves')
+    if outcome.over != game.game_over:
+        problems.append('game_over is {0}, moves say {1}'.format(
+            game.game_over, outcome.over))
+    if game.game_over != (not game.open):
+        problems.append('open does not match game_over')
+    if outcome.over and game.game_winner != outcome.winner:
+        problems.append('wrong winner')
+    if outcome.player_1_turn != game.player_1_turn:
+        problems.append('wrong player to move')
+    if game.game_over:
+        if score is not None:
+            problems.extend(_check_score(score, outcome))
+        elif game.version:
+            # Games that ended before versions existed (version 0) also
+            # predate Scores sharing the game id, so theirs can't be found.
+            problems.append('no Score with the game id')
+    return problems
+
+
+def _check_score(score, outcome):
+    problems = []
+    if score.points != outcome.board.spaces_left():
+        problems.append('Score has {0} points, moves give {1}'.format(
+            score.points, outcome.board.spaces_left()))
+    if outcome.winner is not None:
+        if not score.won or score.winner != outcome.winner:
+            problems.append('Score has the wrong winner')
+    elif outcome.over and score.won:
+        problems.append('Score is a win for a tie')
+    return problems
+
+
+@ndb.transactional(xg=True)
+def fix(game_key, version):
+    """Rewrites the board, turn and outcome of a stored game from its moves,
+    and the points and winner of its Score, if the game is still at the
+    given version. A game the moves say has ended gets its Score and stats
+    recorded as usual. Games whose moves can't be played, or that were ended
+    early, are left alone: there is no safe correction for them. The
+    players' UserStats are never adjusted. Returns True if anything was
+    written."""
+    game = game_key.get()
+    if game is None or game.version != version:
+        return False
+    outcome = replay(game)
+    if outcome.error or (game.game_over and not outcome.over):
+        return False
+    just_ended = outcome.over and not game.game_over
+    game.set_board(outcome.board)
+    game.player_1_turn = outcome.player_1_turn
+    if outcome.over:
+        game.finish(outcome.winner)
+    game.put()
+    if just_ended:
+        game.record_score()
+        gamestats.game_finished(game, outcome.winner is not None)
+        tournaments.game_ended(game)
+    elif outcome.over:
+        score = Score.get_by_id(game_key.id())
+        if score and _check_score(score, outcome):
+            # As in record_score, a tie is stored with user2 as winner.
+            score.winner = outcome.winner or game.user2
+            score.loser = (game.user2 if score.winner == game.user1
+                           else game.user1)
+            score.players = [score.winner, score.loser]
+            score.won = outcome.winner is not None
+            score.points = outcome.board.spaces_left()
+            score.put()
+    return True
+
+
+def validate_batch(run, game_keys, apply_fixes=False):
+    """Checks a batch of games and writes a ReplayIssue for each one with
+    problems, fixing them first if apply_fixes is set. Games being played
+    from the cache are checked from their cached copy and never fixed.
+    Returns the number of games with problems."""
+    games = [game for game in ndb.get_multi(game_keys) if game is not None]
+    live = gamecache.overlay_async(games).get_result()
+    scores = ndb.get_multi([ndb.Key(Score, game.key.id()) for game in live])
+    issues = []
+    for stored, game, score in zip(games, live, scores):
+        problems = check(game, score)
+        if not problems:
+            continue
+        fixed = False
+        if apply_fixes and game is stored:
+            fixed = fix(game.key, game.version)
+            if fixed:
+                gamecache.evict(game.key)
+        issues.append(ReplayIssue(id=ReplayIssue.id_for(run, game.key),
+                                  run=run, game=game.key,
+                                  problems=problems, fixed=fixed))
+    ndb.put_multi(issues)
+    if issues:
+        logging.warning('Replay run %d: %d of %d games have problems', run,
+                        len(issues), len(games))
+    return len(issues)
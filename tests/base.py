@@ -0,0 +1,86 @@
+"""base.py - Test case running against the App Engine testbed stubs.
+
+Needs the App Engine Python SDK. From the project root:
+    GAE_SDK=~/google-cloud-sdk/platform/google_appengine \\
+        python -m unittest discover -s tests -t .
+"""
+
+import os
+import unittest
+
+from benchmark import ROOT, setup_sdk
+
+setup_sdk(os.environ.get('GAE_SDK'))
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed
+
+import api
+import main
+import usernames
+from models import Game
+
+
+class TestCase(unittest.TestCase):
+
+    """Fresh strongly consistent datastore, memcache and task queues for
+    every test. Tasks are not run until run_tasks is called."""
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.
+            PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_app_identity_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+        # Names resolved by an earlier test point at entities now gone.
+        usernames._lru.clear()
+        self.api = api.Connect4Api()
+        self._ran = set()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def make_user(self, name):
+        return usernames.create_user(name, '{0}@example.com'.format(name))
+
+    def make_game(self, user1, user2, **fields):
+        game = Game.build(user1.key, user2.key)
+        game.populate(**fields)
+        game.put()
+        return game
+
+    def tasks(self, url):
+        """Returns the tasks queued for url that haven't been run"""
+        return [task for task in self.taskqueue.get_filtered_tasks(url=url)
+                if task.name not in self._ran]
+
+    def run_tasks(self, url):
+        """Runs the queued tasks for url through main.app, including those
+        they queue, and returns how many ran"""
+        ran = 0
+        while True:
+            tasks = self.tasks(url)
+            if not tasks:
+                return ran
+            for task in tasks:
+                self._ran.add(task.name)
+                response = main.app.get_response(
+                    task.url, method='POST', body=task.payload,
+                    headers={'Content-Type':
+                             'application/x-www-form-urlencoded'})
+                self.assertEqual(response.status_int, 200, response.body)
+                ran += 1
+
+    def play(self, urlsafe_game_key, moves):
+        """Plays (user name, column) moves through make_move and returns the
+        last GameForm"""
+        for name, column in moves:
+            form = self.api.make_move(
+                api.MAKE_MOVE_REQUEST.combined_message_class(
+                    urlsafe_game_key=urlsafe_game_key, user=name,
+                    column=column))
+        return form
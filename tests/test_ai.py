@@ -0,0 +1,32 @@
+"""test_ai.py - Computer player search."""
+
+import time
+
+from tests import base
+
+import ai
+import engine
+
+
+class SearchTest(base.TestCase):
+
+    def test_search_stops_at_the_deadline(self):
+        budget = 0.05
+        start = time.time()
+        # The empty board can't be solved in the budget, so only the
+        # deadline stops the search.
+        search = ai.Search(start + budget,
+                           table=ai.TranspositionTable(ai.TABLE_SIZE))
+        col, _, depth, _ = ai._deepen(
+            search, 0, 0, list(engine.CLASSIC.center_order), (3, 0, 0, 0))
+        self.assertLess(time.time() - start, budget + 0.02)
+        self.assertIn(col, range(engine.CLASSIC.width))
+        self.assertGreater(depth, 0)
+
+    def test_takes_a_winning_move(self):
+        board = engine.Board()
+        for col in (0, 1, 0, 1, 0, 1):
+            board.drop(col, 1 if col == 0 else 2)
+        col, value, _, _ = ai.choose_move(board.bitboards[0], board.mask)
+        self.assertEqual(col, 0)
+        self.assertGreater(value, 0)
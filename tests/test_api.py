@@ -0,0 +1,66 @@
+"""test_api.py - Games played through the endpoints."""
+
+from tests import base
+
+import api
+import gamecache
+from models import Game, Score, UserStats
+
+# user one wins in column 0 on the seventh move.
+WINNING_MOVES = [('one', 0), ('two', 1), ('one', 0), ('two', 1),
+                 ('one', 0), ('two', 1), ('one', 0)]
+
+
+class PlayGameTest(base.TestCase):
+
+    def setUp(self):
+        super(PlayGameTest, self).setUp()
+        self.user1 = self.make_user('one')
+        self.user2 = self.make_user('two')
+        self.form = self.api.new_game(
+            api.NEW_GAME_REQUEST.combined_message_class(user_1='one',
+                                                        user_2='two'))
+        self.game_key = Game.query().get(keys_only=True)
+
+    def test_finished_game_is_scored_once(self):
+        form = self.play(self.form.urlsafe_key, WINNING_MOVES)
+        self.assertTrue(form.game_over)
+        self.assertEqual(form.game_winner, 'one')
+
+        game = self.game_key.get()
+        self.assertTrue(game.game_over)
+        self.assertFalse(game.open)
+        self.assertEqual(game.move_count, len(WINNING_MOVES))
+        scores = Score.query().fetch()
+        self.assertEqual(len(scores), 1)
+        self.assertEqual(scores[0].key.id(), self.game_key.id())
+        self.assertEqual(scores[0].winner, self.user1.key)
+
+        # Neither a move after the end nor the flush task scores it again.
+        self.play(self.form.urlsafe_key, [('two', 2)])
+        self.run_tasks('/tasks/flush_game')
+        self.assertEqual(Score.query().count(), 1)
+        winner = UserStats.key_for(self.user1.key).get()
+        loser = UserStats.key_for(self.user2.key).get()
+        self.assertEqual((winner.wins, winner.losses), (1, 0))
+        self.assertEqual((loser.wins, loser.losses), (0, 1))
+
+    def test_get_game_since_move(self):
+        self.play(self.form.urlsafe_key, WINNING_MOVES[:3])
+        # Read it back from the datastore, through a cache miss.
+        self.run_tasks('/tasks/flush_game')
+        gamecache.evict(self.game_key)
+        form = self.api.get_game(
+            api.GET_GAME_REQUEST.combined_message_class(
+                urlsafe_game_key=self.form.urlsafe_key, since_move=1))
+        self.assertEqual(form.move_count, 3)
+        self.assertEqual(form.first_move, 1)
+
+    def test_watch_game_returns_new_moves(self):
+        self.play(self.form.urlsafe_key, WINNING_MOVES[:2])
+        form = self.api.watch_game(
+            api.WATCH_GAME_REQUEST.combined_message_class(
+                urlsafe_game_key=self.form.urlsafe_key, since_move=1,
+                wait_seconds=0))
+        self.assertEqual(form.move_count, 2)
+        self.assertEqual(form.first_move, 1)
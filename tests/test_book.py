@@ -0,0 +1,78 @@
+"""test_book.py - Position book files and lookups.
+
+Pure Python, so these run without the App Engine SDK:
+    python -m unittest tests.test_book
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import book
+import engine
+
+
+def position_after(columns, geometry=engine.CLASSIC):
+    """Returns (position, mask) for the side to move after the columns are
+    played in turn"""
+    board = engine.Board(geometry=geometry)
+    for number, column in enumerate(columns):
+        board.drop(column, 1 + number % 2)
+    return board.bitboards[len(columns) % 2], board.mask
+
+
+class BookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'book.bin')
+        # A few positions off the center, so their mirror images differ.
+        self.entries = {}
+        for columns, entry in [([], book.Entry(3, 1, 12)),
+                               ([1], book.Entry(2, -2, 10)),
+                               ([1, 2], book.Entry(1, 5, book.SOLVED)),
+                               ([0, 0, 4], book.Entry(0, 0, book.SOLVED))]:
+            position, mask = position_after(columns)
+            key, mirrored = book.canonical_key(engine.CLASSIC, position, mask)
+            if mirrored:
+                entry = entry._replace(
+                    column=engine.CLASSIC.width - 1 - entry.column)
+            self.entries[key] = entry
+        book.write(self.path, engine.CLASSIC, self.entries)
+        self.book = book.load(self.path)
+
+    def test_lookup_finds_every_entry(self):
+        self.assertEqual(self.book.lookup(*position_after([])),
+                         book.Entry(3, 1, 12))
+        self.assertEqual(self.book.lookup(*position_after([1])),
+                         book.Entry(2, -2, 10))
+        self.assertEqual(self.book.lookup(*position_after([1, 2])),
+                         book.Entry(1, 5, book.SOLVED))
+
+    def test_mirror_image_shares_the_entry(self):
+        # Column 1 mirrored is column 5, so the best reply 2 becomes 4.
+        self.assertEqual(self.book.lookup(*position_after([5])),
+                         book.Entry(4, -2, 10))
+        self.assertEqual(self.book.lookup(*position_after([5, 4])),
+                         book.Entry(5, 5, book.SOLVED))
+
+    def test_missing_positions_and_other_variants(self):
+        self.assertIsNone(self.book.lookup(*position_after([3])))
+        other = engine.get_geometry(7, 6, 4)
+        position, mask = position_after([], other)
+        self.assertIsNone(self.book.lookup(position, mask, other))
+
+    def test_search_depth_of_solved_positions(self):
+        position, mask = position_after([0, 0, 4])
+        entry = self.book.lookup(position, mask)
+        self.assertTrue(entry.solved)
+        self.assertEqual(entry.search_depth(mask),
+                         engine.CLASSIC.cells - 3)
+        entry = self.book.lookup(*position_after([1]))
+        self.assertFalse(entry.solved)
+        self.assertEqual(entry.search_depth(position_after([1])[1]), 10)
+
+    def test_load_without_a_book(self):
+        self.assertIsNone(book.load(os.path.join(self.dir, 'missing.bin')))
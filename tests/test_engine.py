@@ -0,0 +1,104 @@
+"""test_engine.py - Bitboard win detection across board sizes.
+
+Pure Python, so these run without the App Engine SDK:
+    python -m unittest tests.test_engine
+"""
+
+import random
+import unittest
+
+import engine
+
+GEOMETRIES = [engine.CLASSIC, engine.get_geometry(7, 6, 4),
+              engine.get_geometry(9, 7, 5), engine.get_geometry(4, 4, 3),
+              engine.get_geometry(10, 5, 7), engine.get_geometry(5, 12, 6),
+              engine.get_geometry(20, 20, 11)]
+# (column, row) step along each line direction.
+STEPS = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+
+def board_of(geometry, cells):
+    """Returns a player's bitboard with chips on the (column, row) cells"""
+    return sum(1 << (col * geometry.column_bits + row) for col, row in cells)
+
+
+def has_line(geometry, cells):
+    """Reference win check, walking every line of the board cell by cell"""
+    cells = set(cells)
+    for col, row in cells:
+        for step_col, step_row in STEPS:
+            if all((col + step * step_col, row + step * step_row) in cells
+                   for step in range(geometry.win_length)):
+                return True
+    return False
+
+
+class WinDetectionTest(unittest.TestCase):
+
+    def test_lines_in_every_direction(self):
+        for geometry in GEOMETRIES:
+            for step_col, step_row in STEPS:
+                length = geometry.win_length
+                end_col = (length - 1) * step_col
+                if end_col >= geometry.width or \
+                        (length - 1) * abs(step_row) >= geometry.height:
+                    continue
+                start_row = length - 1 if step_row < 0 else 0
+                line = [(step * step_col, start_row + step * step_row)
+                        for step in range(length)]
+                self.assertTrue(geometry.is_win(board_of(geometry, line)),
+                                (geometry.width, geometry.height, line))
+                # One chip short is no win, wherever the gap is.
+                for gap in range(length):
+                    broken = line[:gap] + line[gap + 1:]
+                    self.assertFalse(
+                        geometry.is_win(board_of(geometry, broken)),
+                        (geometry.width, geometry.height, broken))
+
+    def test_lines_never_wrap_between_columns(self):
+        for geometry in GEOMETRIES:
+            half = geometry.win_length // 2
+            # The top of one column and the bottom of the next are
+            # neighbouring bits but not a line.
+            cells = ([(0, geometry.height - 1 - row) for row in range(half)] +
+                     [(1, row) for row in range(geometry.win_length - half)])
+            self.assertFalse(geometry.is_win(board_of(geometry, cells)))
+
+    def test_matches_a_direct_scan(self):
+        rand = random.Random(4)
+        for geometry in GEOMETRIES:
+            all_cells = [(col, row) for col in range(geometry.width)
+                         for row in range(geometry.height)]
+            for _ in range(200):
+                cells = rand.sample(all_cells,
+                                    rand.randint(0, len(all_cells) // 2))
+                self.assertEqual(geometry.is_win(board_of(geometry, cells)),
+                                 has_line(geometry, cells),
+                                 (geometry.width, geometry.height, cells))
+
+    def test_board_finds_the_winner(self):
+        for geometry in GEOMETRIES:
+            if geometry.height < geometry.win_length:
+                continue
+            board = engine.Board(geometry=geometry)
+            for _ in range(geometry.win_length - 1):
+                board.drop(0, 1)
+                board.drop(1, 2)
+            self.assertFalse(board.has_won(1))
+            board.drop(0, 1)
+            self.assertTrue(board.has_won(1))
+            self.assertFalse(board.has_won(2))
+
+    def test_drop_checks_the_column(self):
+        geometry = engine.get_geometry(4, 4, 3)
+        board = engine.Board(geometry=geometry)
+        for row in range(geometry.height):
+            self.assertEqual(board.drop(2, 1 + row % 2), row)
+        self.assertFalse(board.can_drop(2))
+        self.assertRaises(ValueError, board.drop, 2, 1)
+        self.assertRaises(ValueError, board.drop, geometry.width, 1)
+
+    def test_sizes_are_checked(self):
+        self.assertRaises(ValueError, engine.get_geometry, 3, 7, 3)
+        self.assertRaises(ValueError, engine.get_geometry, 7, 7, 8)
+        self.assertRaises(ValueError, engine.get_geometry, 7, 7, 2)
@@ -0,0 +1,108 @@
+"""test_gamecache.py - Compare-and-set moves and version-checked saves."""
+
+from google.appengine.api import memcache
+
+from tests import base
+
+import gamecache
+
+
+def drop(column):
+    """Returns an update_game apply function playing column"""
+    def apply(game):
+        game.drop_chip(column)
+        game.record_move(column)
+        game.player_1_turn = not game.player_1_turn
+        return column
+    return apply
+
+
+class GameCacheTest(base.TestCase):
+
+    def setUp(self):
+        super(GameCacheTest, self).setUp()
+        self.user1 = self.make_user('one')
+        self.user2 = self.make_user('two')
+        self.game = self.make_game(self.user1, self.user2)
+
+    def cached(self, game_key):
+        return memcache.get(gamecache._cache_key(game_key))
+
+    def test_moves_are_saved_at_checkpoints(self):
+        for move in range(gamecache.CHECKPOINT_MOVES - 1):
+            gamecache.update_game(self.game.key, drop(move % 2))
+        self.assertEqual(self.game.key.get().version, 0)
+        self.assertEqual(self.cached(self.game.key)[1],
+                         gamecache.CHECKPOINT_MOVES - 1)
+        self.assertEqual(len(self.tasks('/tasks/flush_game')), 1)
+
+        gamecache.update_game(self.game.key, drop(2))
+        self.assertEqual(self.game.key.get().version,
+                         gamecache.CHECKPOINT_MOVES)
+        self.assertEqual(self.cached(self.game.key)[1], 0)
+
+    def test_flush_saves_unsaved_moves(self):
+        gamecache.update_game(self.game.key, drop(3))
+        self.assertEqual(self.game.key.get().version, 0)
+        self.assertEqual(self.run_tasks('/tasks/flush_game'), 1)
+        self.assertEqual(self.game.key.get().moves, chr(3))
+        self.assertEqual(self.cached(self.game.key)[1], 0)
+
+    def test_save_never_replaces_a_newer_version(self):
+        stale = self.game.key.get()
+        stale.record_move(0)
+        newer = self.game.key.get()
+        for column in (1, 2):
+            newer.record_move(column)
+        newer.put()
+        self.assertFalse(gamecache.save(stale))
+        self.assertEqual(self.game.key.get().moves, chr(1) + chr(2))
+
+    def test_save_does_not_bring_back_a_deleted_game(self):
+        game = self.game.key.get()
+        self.game.key.delete()
+        game.record_move(0)
+        self.assertFalse(gamecache.save(game))
+        self.assertIsNone(self.game.key.get())
+
+    def test_failed_save_keeps_the_moves_for_the_flush_task(self):
+        original = gamecache.save
+        self.addCleanup(setattr, gamecache, 'save', original)
+
+        def failing(game):
+            raise RuntimeError('datastore down')
+        gamecache.save = failing
+        for move in range(gamecache.CHECKPOINT_MOVES - 1):
+            gamecache.update_game(self.game.key, drop(move % 2))
+        self.assertRaises(RuntimeError, gamecache.update_game,
+                          self.game.key, drop(2))
+        self.assertEqual(self.cached(self.game.key)[1],
+                         gamecache.CHECKPOINT_MOVES)
+
+        gamecache.save = original
+        self.run_tasks('/tasks/flush_game')
+        self.assertEqual(self.game.key.get().version,
+                         gamecache.CHECKPOINT_MOVES)
+
+    def test_update_games_writes_behind_like_update_game(self):
+        other = self.make_game(self.user2, self.user1)
+        results = gamecache.update_games({self.game.key: drop(0),
+                                          other.key: drop(1)})
+        self.assertEqual(results[self.game.key][1], 0)
+        self.assertEqual(results[other.key][1], 1)
+        for game in self.game, other:
+            self.assertEqual(game.key.get().version, 0)
+            self.assertEqual(self.cached(game.key)[1], 1)
+        self.assertEqual(self.run_tasks('/tasks/flush_game'), 2)
+        self.assertEqual(self.game.key.get().moves, chr(0))
+        self.assertEqual(other.key.get().moves, chr(1))
+
+    def test_update_games_never_replaces_a_newer_checkpoint(self):
+        gamecache.update_games({self.game.key: drop(0)})
+        # A save racing the batch stored a newer version meanwhile.
+        newer = self.game.key.get()
+        for column in (1, 2, 3):
+            newer.record_move(column)
+        newer.put()
+        self.run_tasks('/tasks/flush_game')
+        self.assertEqual(self.game.key.get().moves, chr(1) + chr(2) + chr(3))
@@ -0,0 +1,48 @@
+"""test_matchmaking.py - Pairing waiting players."""
+
+from tests import base
+
+import matchmaking
+from models import Game, QueueEntry
+
+
+class MatchmakingTest(base.TestCase):
+
+    def test_waiting_players_are_paired_once(self):
+        users = [self.make_user(name) for name in ('a', 'b', 'c')]
+        for user in users:
+            matchmaking.join(user)
+        self.assertEqual(matchmaking.pair_waiting(), 1)
+        self.assertEqual(Game.query().count(), 1)
+        self.assertEqual(matchmaking.pair_waiting(), 0)
+
+        game = Game.query().get()
+        for user in users:
+            entry = QueueEntry.get_by_id(user.key.id())
+            if user.key in game.players:
+                self.assertFalse(entry.waiting)
+                self.assertEqual(matchmaking.poll(user.key), game.key)
+            else:
+                self.assertTrue(entry.waiting)
+                self.assertIsNone(matchmaking.poll(user.key))
+
+    def test_long_queue_is_scanned_across_runs(self):
+        original = matchmaking.MATCH_BATCH_SIZE, \
+            matchmaking.MATCH_PAGES_PER_RUN
+        self.addCleanup(setattr, matchmaking, 'MATCH_BATCH_SIZE', original[0])
+        self.addCleanup(setattr, matchmaking, 'MATCH_PAGES_PER_RUN',
+                        original[1])
+        matchmaking.MATCH_BATCH_SIZE, matchmaking.MATCH_PAGES_PER_RUN = 2, 1
+        for name in ('a', 'b', 'c', 'd', 'e', 'f'):
+            matchmaking.join(self.make_user(name))
+        self.assertEqual(matchmaking.pair_waiting(), 1)
+        self.assertEqual(Game.query().count(), 1)
+        # The rest of the queue is left to the runs queued after it.
+        self.assertEqual(self.run_tasks('/tasks/match_players'), 3)
+        self.assertEqual(Game.query().count(), 3)
+        self.assertFalse(QueueEntry.query(QueueEntry.waiting == True).count())
+
+    def test_joining_again_keeps_the_place(self):
+        user = self.make_user('a')
+        joined = matchmaking.join(user).joined
+        self.assertEqual(matchmaking.join(user).joined, joined)
@@ -0,0 +1,123 @@
+"""test_tournaments.py - Rounds advancing as their games end."""
+
+import endpoints
+from google.appengine.ext import ndb
+
+from tests import base
+from tests.test_api import WINNING_MOVES
+
+import api
+import tournaments
+from models import NewTournamentForm
+
+# user2 wins in column 1 on the eighth move.
+LOSING_MOVES = [(0, 0), (1, 1), (0, 2), (1, 1), (0, 0), (1, 1), (0, 2),
+                (1, 1)]
+
+
+class TournamentTest(base.TestCase):
+
+    def create(self, kind, names):
+        for name in names:
+            self.make_user(name)
+        form = self.api.create_tournament(NewTournamentForm(
+            name='cup', kind=kind, user_names=names))
+        return ndb.Key(urlsafe=form.urlsafe_key)
+
+    def play_round(self, tournament_key, round, first_wins=True):
+        """Plays every game of the round to the end and returns the
+        winners' names"""
+        winners = []
+        slot = 0
+        while True:
+            game = tournaments.game_key(tournament_key, round, slot).get()
+            if game is None:
+                return winners
+            names = [game.user1.get().name, game.user2.get().name]
+            if first_wins:
+                moves = [(names[index % 2], column)
+                         for index, (_, column) in enumerate(WINNING_MOVES)]
+            else:
+                moves = [(names[player], column)
+                         for player, column in LOSING_MOVES]
+            self.assertTrue(self.play(game.key.urlsafe(), moves).game_over)
+            winners.append(names[0 if first_wins else 1])
+            slot += 1
+
+    def standings(self, tournament_key):
+        return dict((standing.user_name, standing) for standing in
+                    tournaments.standings_page(tournament_key, 10)[0])
+
+    def test_round_robin_advances_and_finishes(self):
+        tournament_key = self.create('round_robin', ['a', 'b', 'c', 'd'])
+        self.assertEqual(tournament_key.get().round, 1)
+
+        winners = self.play_round(tournament_key, 1)
+        self.assertEqual(len(winners), 2)
+        self.assertEqual(self.run_tasks('/tasks/tournament_result'), 2)
+        self.assertEqual(self.run_tasks('/tasks/tournament_round'), 1)
+        self.assertEqual(tournament_key.get().round, 2)
+        self.assertIsNotNone(tournaments.game_key(tournament_key, 2, 1).get())
+        standings = self.standings(tournament_key)
+        for name in winners:
+            self.assertEqual(standings[name].match_points, 2)
+            self.assertEqual(standings[name].wins, 1)
+
+        for round in (2, 3):
+            self.play_round(tournament_key, round)
+            self.run_tasks('/tasks/tournament_result')
+            self.run_tasks('/tasks/tournament_round')
+        tournament = tournament_key.get()
+        self.assertTrue(tournament.finished)
+        standings = self.standings(tournament_key)
+        leader = tournaments.standings_page(tournament_key, 1)[0][0]
+        champion = standings[tournament.champion.get().name]
+        self.assertEqual((champion.match_points, champion.points),
+                         (leader.match_points, leader.points))
+        # Everyone met everyone once.
+        self.assertEqual(sum(standing.wins
+                             for standing in standings.values()), 6)
+
+    def test_result_is_recorded_once(self):
+        tournament_key = self.create('round_robin', ['a', 'b'])
+        game = tournaments.game_key(tournament_key, 1, 0).get()
+        self.play_round(tournament_key, 1)
+        self.run_tasks('/tasks/tournament_result')
+        before = self.standings(tournament_key)
+
+        # A retried result task changes nothing and queues no new round.
+        tournaments.record_result(tournament_key, 1, 0, game.user1,
+                                  game.user2, game.user1, 10)
+        after = self.standings(tournament_key)
+        for name in before:
+            self.assertEqual(before[name].to_dict(), after[name].to_dict())
+        self.assertEqual(self.run_tasks('/tasks/tournament_round'), 1)
+        self.assertTrue(tournament_key.get().finished)
+
+    def test_elimination_bye_and_champion(self):
+        tournament_key = self.create('elimination', ['a', 'b', 'c'])
+        self.assertEqual(tournament_key.get().rounds, 2)
+        self.assertEqual(self.play_round(tournament_key, 1,
+                                         first_wins=False), ['c'])
+        self.run_tasks('/tasks/tournament_result')
+        self.run_tasks('/tasks/tournament_round')
+
+        # The winner meets b, who had a bye.
+        final = tournaments.game_key(tournament_key, 2, 0).get()
+        self.assertEqual([final.user1.get().name, final.user2.get().name],
+                         ['c', 'b'])
+        self.play_round(tournament_key, 2)
+        self.run_tasks('/tasks/tournament_result')
+        self.run_tasks('/tasks/tournament_round')
+        tournament = tournament_key.get()
+        self.assertTrue(tournament.finished)
+        self.assertEqual(tournament.champion.get().name, 'c')
+
+    def test_tournament_games_cannot_be_cancelled(self):
+        tournament_key = self.create('elimination', ['a', 'b'])
+        game_key = tournaments.game_key(tournament_key, 1, 0)
+        with self.assertRaises(endpoints.ConflictException):
+            self.api.cancel_game(
+                api.CANCEL_GAME_REQUEST.combined_message_class(
+                    urlsafe_game_key=game_key.urlsafe()))
+        self.assertIsNotNone(game_key.get())
@@ -0,0 +1,270 @@
+"""tournaments.py - Round robin and single elimination tournaments.
+
+create() stores the Tournament with a TournamentStanding per player and
+starts round 1.  The games of a round are created together with batched
+puts, under ids made of the tournament, round and slot, so a retried round
+start never creates a game twice.  When a tournament game ends, gamecache
+enqueues a result task in the transaction that saves it.  The task stores
+the game's TournamentResult, updates both players' standings and counts the
+result in one of the round's ROUND_SHARDS counter shards, all in one
+transaction, so the games of a round don't contend on a shared entity.  It
+then sums the shards; the task of the last result to commit finds them all
+counted and marks the round complete, scheduling the next round in that
+transaction.  Standings are kept sorted by the datastore, so a page of them
+is one indexed query whatever the size of the tournament."""
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import engine
+import gamestats
+from models import (Game, Tournament, TournamentResult, TournamentRound,
+                    TournamentRoundShard, TournamentStanding)
+
+ROUND_ROBIN = 'round_robin'
+ELIMINATION = 'elimination'
+MAX_PLAYERS = 1000
+PUT_BATCH_SIZE = 500
+ROUND_SHARDS = 10
+
+
+def rounds_for(kind, players):
+    """Returns the number of rounds of a tournament of that many players"""
+    if kind == ROUND_ROBIN:
+        return players - 1 if players % 2 == 0 else players
+    return (players - 1).bit_length()
+
+
+def _put_batched(entities):
+    for start in range(0, len(entities), PUT_BATCH_SIZE):
+        ndb.put_multi(entities[start:start + PUT_BATCH_SIZE])
+
+
+def create(name, kind, users, geometry=engine.CLASSIC):
+    """Creates a tournament between the users, in seed order, and starts its
+    first round. Raises ValueError if the tournament can't be played."""
+    if kind not in (ROUND_ROBIN, ELIMINATION):
+        raise ValueError('kind must be {0} or {1}'.format(ROUND_ROBIN,
+                                                          ELIMINATION))
+    if not 2 <= len(users) <= MAX_PLAYERS:
+        raise ValueError('A tournament needs 2 to {0} players'.format(
+            MAX_PLAYERS))
+    if len(set(user.key for user in users)) != len(users):
+        raise ValueError('Every player can only enter once')
+    tournament = Tournament(name=name, kind=kind,
+                            players=[user.key for user in users],
+                            width=geometry.width, height=geometry.height,
+                            win_length=geometry.win_length,
+                            rounds=rounds_for(kind, len(users)))
+    tournament.put()
+    _put_batched([TournamentStanding(
+        key=TournamentStanding.key_for(tournament.key, user.key),
+        tournament=tournament.key, user=user.key, user_name=user.name)
+        for user in users])
+    start_round(tournament.key, 1)
+    return tournament.key.get()
+
+
+def _pairings(tournament, round):
+    """Returns the (user1, user2) pairs and the players with a bye of a
+    round"""
+    if tournament.kind == ROUND_ROBIN:
+        players = list(tournament.players)
+        if len(players) % 2:
+            players.append(None)
+        # Circle method: the first player stays put and the others rotate
+        # one place per round, so everyone meets once.
+        rest = players[1:]
+        shift = (round - 1) % len(rest)
+        circle = [players[0]] + rest[len(rest) - shift:] + \
+            rest[:len(rest) - shift]
+        pairs = []
+        for index in range(len(circle) // 2):
+            pair = circle[index], circle[-1 - index]
+            if round % 2 == 0:
+                # Alternate who moves first.
+                pair = pair[1], pair[0]
+            if None not in pair:
+                pairs.append(pair)
+        return pairs, []
+
+    players = (tournament.players if round == 1 else
+               _advancing(tournament.key, round - 1))
+    # Best remaining seed against the worst.
+    half = len(players) // 2
+    pairs = [(players[index], players[-1 - index]) for index in range(half)]
+    return pairs, players[half:len(players) - half]
+
+
+def _advancing(tournament_key, round):
+    """Returns the players going through from an elimination round, in
+    slot order, followed by those who had a bye"""
+    previous = TournamentRound.key_for(tournament_key, round).get()
+    results = ndb.get_multi([
+        TournamentResult.key_for(tournament_key, round, slot)
+        for slot in range(previous.games)])
+    return [result.advancing for result in results] + previous.byes
+
+
+def game_key(tournament_key, round, slot):
+    return ndb.Key(Game, 't{0}-r{1}-s{2}'.format(tournament_key.id(), round,
+                                                 slot))
+
+
+def start_round(tournament_key, round):
+    """Creates the games of a round. Safe to retry: the round is begun once
+    and only the games not created yet are put."""
+    tournament = tournament_key.get()
+    if tournament is None or tournament.finished or tournament.round > round:
+        return
+    pairs, byes = _pairings(tournament, round)
+    if tournament.round < round:
+        _begin_round(tournament_key, round, len(pairs), byes)
+    keys = [game_key(tournament_key, round, slot)
+            for slot in range(len(pairs))]
+    geometry = engine.get_geometry(tournament.width, tournament.height,
+                                   tournament.win_length)
+    games = []
+    for slot, (key, existing) in enumerate(zip(keys, ndb.get_multi(keys))):
+        if existing is None:
+            game = Game.build(pairs[slot][0], pairs[slot][1],
+                              geometry=geometry)
+            game.key = key
+            game.tournament = tournament_key
+            game.tournament_round = round
+            game.tournament_slot = slot
+            games.append(game)
+    _put_batched(games)
+    if games:
+        gamestats.record(games_created=len(games))
+
+
+@ndb.transactional(xg=True)
+def _begin_round(tournament_key, round, games, byes):
+    tournament = tournament_key.get()
+    if tournament.round >= round:
+        return
+    tournament.round = round
+    ndb.put_multi([tournament, TournamentRound(
+        key=TournamentRound.key_for(tournament_key, round), games=games,
+        byes=byes)])
+
+
+def game_ended(game):
+    """Enqueues the result of a tournament game that just ended. Call it in
+    the transaction that saves the ended game, so the result is recorded
+    exactly once the game is."""
+    if not game.tournament:
+        return
+    taskqueue.add(url='/tasks/tournament_result', transactional=True,
+                  params={'tournament': game.tournament.urlsafe(),
+                          'round': game.tournament_round,
+                          'slot': game.tournament_slot,
+                          'user1': game.user1.urlsafe(),
+                          'user2': game.user2.urlsafe(),
+                          'winner': game.game_winner.urlsafe()
+                          if game.game_winner else '',
+                          'points': game.spaces_left()})
+
+
+def _shard_keys(tournament_key, round):
+    return [ndb.Key(TournamentRoundShard, '{0}-{1}-{2}'.format(
+        tournament_key.id(), round, shard)) for shard in range(ROUND_SHARDS)]
+
+
+def record_result(tournament_key, round, slot, user1, user2, winner,
+                  points):
+    """Adds a game's result to the players' standings and its round, and
+    schedules the next round if the round is now complete. A result
+    already recorded is ignored, so the task can be retried."""
+    _store_result(tournament_key, round, slot, user1, user2, winner, points)
+    _complete_round(tournament_key, round)
+
+
+@ndb.transactional(xg=True)
+def _store_result(tournament_key, round, slot, user1, user2, winner,
+                  points):
+    result_key = TournamentResult.key_for(tournament_key, round, slot)
+    shard_key = _shard_keys(tournament_key, round)[slot % ROUND_SHARDS]
+    tournament, result, shard, first, second = ndb.get_multi([
+        tournament_key, result_key, shard_key,
+        TournamentStanding.key_for(tournament_key, user1),
+        TournamentStanding.key_for(tournament_key, user2)])
+    if result:
+        return
+    if winner:
+        winning, losing = (first, second) if winner == user1 else \
+            (second, first)
+        winning.wins += 1
+        winning.match_points += 2
+        winning.points += points
+        losing.losses += 1
+        advancing = winner
+    else:
+        for standing in first, second:
+            standing.ties += 1
+            standing.match_points += 1
+        # An elimination tie goes to the better seed.
+        advancing = min(user1, user2, key=tournament.players.index)
+    shard = shard or TournamentRoundShard(key=shard_key)
+    shard.results += 1
+    ndb.put_multi([TournamentResult(key=result_key, advancing=advancing),
+                   shard, first, second])
+
+
+@ndb.transactional(xg=True)
+def _complete_round(tournament_key, round):
+    """Marks the round complete and schedules the next one if every game
+    has a result and no earlier call did so already"""
+    progress = TournamentRound.key_for(tournament_key, round).get()
+    if progress.complete:
+        return
+    shards = ndb.get_multi(_shard_keys(tournament_key, round))
+    if sum(shard.results for shard in shards if shard) < progress.games:
+        return
+    progress.complete = True
+    progress.put()
+    taskqueue.add(url='/tasks/tournament_round', transactional=True,
+                  params={'tournament': tournament_key.urlsafe(),
+                          'round': round + 1})
+
+
+def advance(tournament_key, round):
+    """Starts the round, or finishes the tournament if it has been played"""
+    tournament = tournament_key.get()
+    if tournament is None or tournament.finished:
+        return
+    if tournament.kind == ELIMINATION:
+        remaining = _advancing(tournament_key, round - 1)
+        if len(remaining) == 1:
+            _finish(tournament_key, remaining[0])
+            return
+    elif round > tournament.rounds:
+        # Read by key, so the last round's results are all seen. Equal
+        # records go to the better seed.
+        standings = ndb.get_multi([
+            TournamentStanding.key_for(tournament_key, user_key)
+            for user_key in tournament.players])
+        leader = max(standings, key=lambda standing: (standing.match_points,
+                                                      standing.points))
+        _finish(tournament_key, leader.user)
+        return
+    start_round(tournament_key, round)
+
+
+@ndb.transactional
+def _finish(tournament_key, champion):
+    tournament = tournament_key.get()
+    tournament.finished = True
+    tournament.champion = champion
+    tournament.put()
+
+
+def standings_page(tournament_key, page_size, cursor=None):
+    """Returns (standings, cursor, more) for a page of the standings, best
+    first"""
+    return TournamentStanding.query(
+        TournamentStanding.tournament == tournament_key).order(
+            -TournamentStanding.match_points,
+            -TournamentStanding.points).fetch_page(page_size,
+                                                   start_cursor=cursor)
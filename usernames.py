@@ -0,0 +1,125 @@
+"""usernames.py - Resolves user names to User keys.
+
+Every User has a UserName entity keyed by its normalized name, so a name
+lookup is a strongly consistent get instead of a query, and create_user can
+reserve a name atomically.  Resolved keys are kept in a bounded in-process
+LRU and in memcache.  A name never points to a different User once
+reserved, so cached entries never need dropping.  Users created before
+reservations existed get theirs from the user_names backfill job."""
+
+import threading
+from collections import OrderedDict
+
+from google.appengine.ext import ndb
+
+from models import User, UserName, UserStats
+
+MEMCACHE_USER_NAME = 'USERNAME:'
+LRU_SIZE = 2000
+
+_lru = OrderedDict()
+_lru_lock = threading.Lock()
+
+
+def normalize(name):
+    return name.strip().lower()
+
+
+def _lru_get(name):
+    with _lru_lock:
+        key = _lru.pop(name, None)
+        if key is not None:
+            _lru[name] = key
+        return key
+
+
+def _lru_put(name, key):
+    with _lru_lock:
+        _lru.pop(name, None)
+        _lru[name] = key
+        while len(_lru) > LRU_SIZE:
+            _lru.popitem(last=False)
+
+
+@ndb.transactional(xg=True)
+def create_user(name, email=None, stats=True):
+    """Reserves the name and creates its User and UserStats in one
+    transaction. Returns the new User, or None if the name is taken. With
+    stats False the User gets no UserStats and stays out of the rankings,
+    as the computer player does."""
+    if UserName.get_by_id(normalize(name)):
+        return None
+    user = User(name=name, email=email)
+    user.put()
+    entities = [UserName(id=normalize(name), user=user.key)]
+    if stats:
+        entities.append(UserStats.for_user(user))
+    ndb.put_multi(entities)
+    return user
+
+
+@ndb.tasklet
+def get_user_keys_async(names):
+    """Tasklet returning a dict of name (as given) to User key for the names
+    that exist, checking the LRU, then memcache, then the UserName entities
+    with one batch each"""
+    ctx = ndb.get_context()
+    normalized = dict((name, normalize(name)) for name in names
+                      if name and normalize(name))
+    keys = {}
+    for norm in set(normalized.values()):
+        key = _lru_get(norm)
+        if key is not None:
+            keys[norm] = key
+
+    missing = [norm for norm in set(normalized.values()) if norm not in keys]
+    if missing:
+        # The context batches these into one memcache get_multi.
+        cached = yield [ctx.memcache_get(MEMCACHE_USER_NAME + norm)
+                        for norm in missing]
+        for norm, urlsafe in zip(missing, cached):
+            if urlsafe:
+                keys[norm] = ndb.Key(urlsafe=urlsafe)
+        missing = [norm for norm in missing if norm not in keys]
+
+    if missing:
+        reservations = yield ndb.get_multi_async(
+            [ndb.Key(UserName, norm) for norm in missing])
+        found = {}
+        for norm, reservation in zip(missing, reservations):
+            if reservation:
+                found[norm] = reservation.user
+        yield [ctx.memcache_set(MEMCACHE_USER_NAME + norm, key.urlsafe())
+               for norm, key in found.items()]
+        keys.update(found)
+
+    for norm, key in keys.items():
+        _lru_put(norm, key)
+    raise ndb.Return(dict((name, keys[norm])
+                          for name, norm in normalized.items()
+                          if norm in keys))
+
+
+def get_user_keys(names):
+    return get_user_keys_async(names).get_result()
+
+
+@ndb.tasklet
+def get_users_async(names):
+    """Tasklet returning a dict of name (as given) to User for the names that
+    exist"""
+    keys = yield get_user_keys_async(names)
+    users = yield ndb.get_multi_async(keys.values())
+    users = dict(zip(keys.values(), users))
+    raise ndb.Return(dict((name, users[key]) for name, key in keys.items()
+                          if users[key] is not None))
+
+
+def get_users(names):
+    """Returns a dict of name (as given) to User for the names that exist"""
+    return get_users_async(names).get_result()
+
+
+def get_user(name):
+    """Returns the User with the given name, or None"""
+    return get_users([name]).get(name)
@@ -1,22 +1,22 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key a urlsafe key string points to without loading
+        the entity. Checks that the key is of the expected kind.
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The decoded ndb.Key
     Raises:
-        ValueError:"""
+        endpoints.BadRequestException: if the key String is malformed
+        ValueError: if the key is of the incorrect kind"""
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
@@ -27,9 +27,62 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
+    if key.kind() != model._get_kind():
         raise ValueError('Incorrect Kind')
-    return entity
+    return key
+
+
+def get_cursor(urlsafe):
+    """Returns the datastore Cursor for a urlsafe cursor string sent by a
+        client, or None to start from the first page.
+    Raises:
+        endpoints.BadRequestException: if the string is not a valid cursor"""
+    if not urlsafe:
+        return None
+    try:
+        return Cursor(urlsafe=urlsafe)
+    except datastore_errors.BadValueError:
+        raise endpoints.BadRequestException('Invalid cursor')
+
+
+def next_cursor(cursor, more):
+    """Returns the urlsafe form of a fetch_page cursor, or None on the last
+        page"""
+    if more and cursor:
+        return cursor.urlsafe()
+    return None
+
+
+class EntityMap(object):
+    """Request-scoped identity map. Collects the keys needed to build a
+    response, fetches the missing ones with a single ndb.get_multi and serves
+    repeated lookups from memory. Create one per request; it is never shared
+    between requests so it cannot serve stale entities."""
+
+    def __init__(self):
+        self._entities = {}
+
+    @ndb.tasklet
+    def prefetch_async(self, keys):
+        """Tasklet loading every key not already in the map in one batch."""
+        missing = list(set(key for key in keys
+                           if key is not None and key not in self._entities))
+        if missing:
+            entities = yield ndb.get_multi_async(missing)
+            self._entities.update(zip(missing, entities))
+
+    def prefetch(self, keys):
+        """Loads every key not already in the map in one batch."""
+        self.prefetch_async(keys).get_result()
+
+    def add(self, entity):
+        """Registers an entity the caller has already loaded."""
+        if entity is not None and entity.key is not None:
+            self._entities[entity.key] = entity
+
+    def get(self, key):
+        if key is None:
+            return None
+        if key not in self._entities:
+            self.prefetch([key])
+        return self._entities[key]